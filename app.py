@@ -3,20 +3,40 @@
 # ============================================================================
 
 import os
+import atexit
 import json
+import threading
+import queue
+import random
+import zlib
+import sqlite3
+import functools
+import hashlib
+import heapq
+import itertools
+import base64
+import sys
+import re
+import unicodedata
+import uuid
+try:
+    import fcntl
+except ImportError:  # Windows: solo locks dentro del proceso
+    fcntl = None
+from collections import OrderedDict, deque
+from enum import Enum
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from contextlib import contextmanager
+from cachetools import TTLCache
 import requests
+import httpx
 from flask import Flask, request, jsonify
 from datetime import datetime, timedelta
-import openai  # Para ChatGPT
-# from anthropic import Anthropic  # Para Claude (alternativa)
-
-# Librerías para videollamadas
-import jwt
 import time
-from google.oauth2.credentials import Credentials
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
+
+# Los SDK de proveedores (openai, google-auth, googleapiclient) se importan
+# de forma perezosa en su primer uso para acelerar el arranque de cada worker.
+# Ver get_openai_client(), get_google_calendar_service() y warmup().
 
 # ============================================================================
 # CONFIGURACIÓN INICIAL
@@ -24,59 +44,393 @@ from googleapiclient.errors import HttpError
 
 app = Flask(__name__)
 
+# Calentar los SDK de proveedores al crear la app (ver create_app)
+APP_WARMUP = os.getenv('APP_WARMUP', 'false').lower() == 'true'
+
 # Configuración de WhatsApp Cloud API
 WHATSAPP_TOKEN = os.getenv('WHATSAPP_TOKEN')
 WHATSAPP_PHONE_ID = os.getenv('WHATSAPP_PHONE_ID')
 VERIFY_TOKEN = "TWSCodeJG#75" #os.getenv('VERIFY_TOKEN')
+WHATSAPP_API_VERSION = os.getenv('WHATSAPP_API_VERSION', 'v22.0')
+WHATSAPP_TIMEOUT = float(os.getenv('WHATSAPP_TIMEOUT', '10'))
+WHATSAPP_CONNECT_TIMEOUT = float(os.getenv('WHATSAPP_CONNECT_TIMEOUT', '3'))
+WHATSAPP_MAX_CONNECTIONS = int(os.getenv('WHATSAPP_MAX_CONNECTIONS', '20'))
+WHATSAPP_HTTP2 = os.getenv('WHATSAPP_HTTP2', 'false').lower() == 'true'
+WHATSAPP_MAX_TEXT_LENGTH = 4096  # Límite de la API para el cuerpo de un mensaje de texto
 
 # Configuración de IA
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
-openai.api_key = OPENAI_API_KEY
+OPENAI_TIMEOUT = float(os.getenv('OPENAI_TIMEOUT', '30'))
+AI_MODEL = os.getenv('AI_MODEL', 'gpt-4')
+AI_FALLBACK_MODEL = os.getenv('AI_FALLBACK_MODEL', 'gpt-3.5-turbo')  # vacío = sin respaldo
+AI_MAX_IN_FLIGHT = int(os.getenv('AI_MAX_IN_FLIGHT', '8'))
+AI_FALLBACK_MAX_IN_FLIGHT = int(os.getenv('AI_FALLBACK_MAX_IN_FLIGHT', '8'))
+AI_QUEUE_TIMEOUT = float(os.getenv('AI_QUEUE_TIMEOUT', '5'))
+
+# Respuestas de IA enviadas por partes a medida que se generan
+AI_STREAMING = os.getenv('AI_STREAMING', 'true').lower() == 'true'
+AI_STREAM_MIN_CHARS = int(os.getenv('AI_STREAM_MIN_CHARS', '160'))
+AI_STREAM_MIN_INTERVAL = float(os.getenv('AI_STREAM_MIN_INTERVAL', '1.5'))
+AI_STREAM_MAX_MESSAGES = int(os.getenv('AI_STREAM_MAX_MESSAGES', '4'))
+
+# Contexto de conversación enviado a la IA en el chat con el doctor
+AI_CONTEXT_MAX_TOKENS = int(os.getenv('AI_CONTEXT_MAX_TOKENS', '1000'))
+AI_CONTEXT_SUMMARIZE = os.getenv('AI_CONTEXT_SUMMARIZE', 'false').lower() == 'true'
+AI_CONTEXT_SUMMARY_TOKENS = int(os.getenv('AI_CONTEXT_SUMMARY_TOKENS', '150'))
+
+# Caché de respuestas de IA por pregunta normalizada
+AI_CACHE_TTL = int(os.getenv('AI_CACHE_TTL', '86400'))
+AI_CACHE_MAX_SIZE = int(os.getenv('AI_CACHE_MAX_SIZE', '2000'))
+AI_CACHE_NEAR_DUPLICATES = os.getenv('AI_CACHE_NEAR_DUPLICATES', 'false').lower() == 'true'
+AI_CACHE_SIMILARITY = float(os.getenv('AI_CACHE_SIMILARITY', '0.8'))
+
+# Preguntas frecuentes respondidas sin llamar a la IA
+FAQ_FILE = os.getenv('FAQ_FILE', 'faq_ortopedia.json')
+FAQ_THRESHOLD = float(os.getenv('FAQ_THRESHOLD', '0.6'))
+FAQ_RELOAD_INTERVAL = float(os.getenv('FAQ_RELOAD_INTERVAL', '30'))
 
 # Configuración de tu API de Base de Datos
 API_BASE_URL = os.getenv('API_BASE_URL', 'https://appsintranet.esculapiosis.com/ApiCampbell/api')
 API_KEY = os.getenv('API_KEY')
+PATIENT_API_TIMEOUT = float(os.getenv('PATIENT_API_TIMEOUT', '10'))
+# Presupuesto por endpoint, ej: "validate_cedula=3,appointments=5"
+PATIENT_API_TIMEOUTS = os.getenv('PATIENT_API_TIMEOUTS', 'validate_cedula=3,appointments=5,contact_phones=5')
+PATIENT_API_MAX_CONNECTIONS = int(os.getenv('PATIENT_API_MAX_CONNECTIONS', '20'))
+PATIENT_API_CONCURRENCY_INITIAL = int(os.getenv('PATIENT_API_CONCURRENCY_INITIAL', '8'))
+PATIENT_API_CONCURRENCY_MIN = int(os.getenv('PATIENT_API_CONCURRENCY_MIN', '2'))
+PATIENT_API_CONCURRENCY_MAX = int(os.getenv('PATIENT_API_CONCURRENCY_MAX', '32'))
+PATIENT_API_LATENCY_TARGET_MS = float(os.getenv('PATIENT_API_LATENCY_TARGET_MS', '1500'))
+PATIENT_API_QUEUE_TIMEOUT = float(os.getenv('PATIENT_API_QUEUE_TIMEOUT', '2'))
+
+# Escrituras diferidas (estudios y videollamadas) en un spool local durable
+WRITE_BEHIND_ENABLED = os.getenv('WRITE_BEHIND_ENABLED', 'true').lower() == 'true'
+SPOOL_DB_PATH = os.getenv('SPOOL_DB_PATH', 'spool.db')
+SPOOL_BATCH_SIZE = int(os.getenv('SPOOL_BATCH_SIZE', '20'))
+SPOOL_FLUSH_INTERVAL = float(os.getenv('SPOOL_FLUSH_INTERVAL', '2'))
+SPOOL_MAX_AGE_HOURS = float(os.getenv('SPOOL_MAX_AGE_HOURS', '72'))
 
 # Configuración de Zoom API
 ZOOM_API_KEY = os.getenv('ZOOM_API_KEY')
 ZOOM_API_SECRET = os.getenv('ZOOM_API_SECRET')
 ZOOM_ACCOUNT_ID = os.getenv('ZOOM_ACCOUNT_ID')
+ZOOM_TIMEOUT = float(os.getenv('ZOOM_TIMEOUT', '10'))
+ZOOM_TOKEN_REFRESH_MARGIN = int(os.getenv('ZOOM_TOKEN_REFRESH_MARGIN', '300'))
 
 # Configuración de Google Meet API
 GOOGLE_CREDENTIALS_FILE = os.getenv('GOOGLE_CREDENTIALS_FILE', 'credentials.json')
 GOOGLE_CALENDAR_ID = os.getenv('GOOGLE_CALENDAR_ID', 'primary')
+GOOGLE_API_TIMEOUT = float(os.getenv('GOOGLE_API_TIMEOUT', '10'))
+
+# Pool de salas de videollamada precreadas (0 = desactivado), por worker.
+# Costo de cuota: cada sala entregada o vencida se reemplaza con una llamada de
+# creación; sin tráfico son size × workers creaciones por TTL y por plataforma
+# (más las del arranque de cada worker).
+MEETING_POOL_SIZE = int(os.getenv('MEETING_POOL_SIZE', '0'))
+MEETING_POOL_TTL = int(os.getenv('MEETING_POOL_TTL', '86400'))
+
+# Creación de videollamadas en segundo plano con entrega diferida del enlace
+VIDEO_CALL_ASYNC = os.getenv('VIDEO_CALL_ASYNC', 'true').lower() == 'true'
+VIDEO_CALL_TIMEOUT = float(os.getenv('VIDEO_CALL_TIMEOUT', '15'))
+VIDEO_CALL_WORKERS = int(os.getenv('VIDEO_CALL_WORKERS', '4'))
+
+# Circuit breakers por dependencia externa
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv('CIRCUIT_FAILURE_THRESHOLD', '5'))
+CIRCUIT_RESET_TIMEOUT = float(os.getenv('CIRCUIT_RESET_TIMEOUT', '30'))
+
+# Procesamiento del webhook en segundo plano
+WEBHOOK_ASYNC = os.getenv('WEBHOOK_ASYNC', 'false').lower() == 'true'
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', '8'))
+WEBHOOK_QUEUE_SIZE = int(os.getenv('WEBHOOK_QUEUE_SIZE', '200'))
+WEBHOOK_BATCH_WORKERS = int(os.getenv('WEBHOOK_BATCH_WORKERS', '8'))
+USER_LOCK_STRIPES = int(os.getenv('USER_LOCK_STRIPES', '1024'))
+USER_LOCK_PATH = os.getenv('USER_LOCK_PATH')  # Archivo de locks compartido entre workers (opcional)
+
+# Deduplicación de mensajes reenviados por Meta
+DEDUP_TTL = int(os.getenv('DEDUP_TTL', '86400'))
+DEDUP_MAX_SIZE = int(os.getenv('DEDUP_MAX_SIZE', '100000'))
+DEDUP_DB_PATH = os.getenv('DEDUP_DB_PATH')  # SQLite compartido entre workers (opcional)
+
+# Caché de consultas de pacientes por cédula (segundos / cantidad de entradas)
+CEDULA_CACHE_TTL = int(os.getenv('CEDULA_CACHE_TTL', '600'))
+CEDULA_NEGATIVE_TTL = int(os.getenv('CEDULA_NEGATIVE_TTL', '60'))
+CEDULA_CACHE_MAX_SIZE = int(os.getenv('CEDULA_CACHE_MAX_SIZE', '10000'))
+
+# Caché de citas y teléfonos (servida desde memoria, refrescada en segundo plano)
+REFERENCE_CACHE_REFRESH = int(os.getenv('REFERENCE_CACHE_REFRESH', '60'))
+REFERENCE_CACHE_WARMUP = os.getenv('REFERENCE_CACHE_WARMUP', 'true').lower() == 'true'
+
+# Almacenamiento de sesiones de usuario
+SESSION_BACKEND = os.getenv('SESSION_BACKEND', 'memory')  # memory | sqlite
+SESSION_TTL = int(os.getenv('SESSION_TTL', '86400'))
+SESSION_MAX_SIZE = int(os.getenv('SESSION_MAX_SIZE', '50000'))
+SESSION_DB_PATH = os.getenv('SESSION_DB_PATH', 'sessions.db')
+SESSION_HISTORY_SIZE = int(os.getenv('SESSION_HISTORY_SIZE', '20'))
+SESSION_HISTORY_HOT_TURNS = int(os.getenv('SESSION_HISTORY_HOT_TURNS', '4'))
+SESSION_HISTORY_COMPRESS = os.getenv('SESSION_HISTORY_COMPRESS', 'false').lower() == 'true'
+
+# ============================================================================
+# MÉTRICAS
+# ============================================================================
+
+class Metrics:
+    """Contadores y observaciones en memoria, expuestos en /metrics"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._observations = {}
+        self._gauges = {}
+
+    def register_gauge(self, name, func):
+        """Registra una función que se evalúa al leer las métricas"""
+        with self._lock:
+            self._gauges[name] = func
+
+    def incr(self, name, value=1):
+        """Incrementa un contador"""
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def observe(self, name, value):
+        """Registra una observación (conteo, suma y máximo)"""
+        with self._lock:
+            obs = self._observations.setdefault(name, {"count": 0, "sum": 0, "max": 0})
+            obs["count"] += 1
+            obs["sum"] += value
+            obs["max"] = max(obs["max"], value)
+
+    def get(self, name):
+        """Valor actual de un contador"""
+        with self._lock:
+            return self._counters.get(name, 0)
+
+    def snapshot(self):
+        """Copia de todas las métricas"""
+        with self._lock:
+            observations = {}
+            for name, obs in self._observations.items():
+                observations[name] = dict(obs, avg=obs["sum"] / obs["count"] if obs["count"] else 0)
+            counters = dict(self._counters)
+            gauges = dict(self._gauges)
+        values = {}
+        for name, func in gauges.items():
+            try:
+                values[name] = func()
+            except Exception as e:
+                values[name] = {"error": str(e)}
+        return {"counters": counters, "observations": observations, "gauges": values}
+
+metrics = Metrics()
+
+# ============================================================================
+# CIRCUIT BREAKERS
+# ============================================================================
+
+class CircuitOpenError(Exception):
+    """La dependencia está marcada como caída; se falla de inmediato"""
+
+class Overloaded(Exception):
+    """Rechazo local por falta de cupo; no cuenta como falla de la dependencia"""
+
+class CircuitBreaker:
+    """Circuit breaker cerrado / abierto / semiabierto para una dependencia.
+
+    Tras `failure_threshold` fallos consecutivos se abre y rechaza llamadas
+    durante `reset_timeout` segundos; luego deja pasar una llamada de prueba
+    (semiabierto) que decide si vuelve a cerrarse o a abrirse.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name, failure_threshold=CIRCUIT_FAILURE_THRESHOLD, reset_timeout=CIRCUIT_RESET_TIMEOUT):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    def _transition(self, state):
+        metrics.incr(f"circuit_{self.name}_{self.state}_to_{state}")
+        print(f"Circuit breaker {self.name}: {self.state} -> {state}")
+        self.state = state
 
-# Almacenamiento temporal de sesiones de usuario
-user_sessions = {}
+    def allow(self):
+        """Indica si se puede llamar a la dependencia"""
+        with self._lock:
+            if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self._transition(self.HALF_OPEN)
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.HALF_OPEN and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+        metrics.incr(f"circuit_{self.name}_rejected")
+        return False
+
+    def cancel(self):
+        """Libera una llamada permitida que no llegó a ejecutarse"""
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record(self, ok):
+        """Registra el resultado de una llamada permitida"""
+        with self._lock:
+            self._trial_in_flight = False
+            if ok:
+                self._failures = 0
+                if self.state != self.CLOSED:
+                    self._transition(self.CLOSED)
+                return
+            self._failures += 1
+            if self.state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    self._transition(self.OPEN)
+                self._opened_at = time.monotonic()
+
+circuit_breakers = {
+    name: CircuitBreaker(name)
+    for name in ("patient_api", "openai", "zoom", "google_calendar")
+}
+metrics.register_gauge("circuits", lambda: {name: cb.state for name, cb in circuit_breakers.items()})
+
+def protected_by(name, fallback):
+    """Decorador: protege una función que retorna `fallback` cuando falla.
+
+    Si la función lanza Overloaded se responde `fallback` sin contar un fallo.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            breaker = circuit_breakers[name]
+            if not breaker.allow():
+                return fallback
+            try:
+                result = func(*args, **kwargs)
+            except Overloaded:
+                breaker.cancel()
+                return fallback
+            except Exception:
+                breaker.record(False)
+                raise
+            breaker.record(result != fallback)
+            return result
+        return wrapper
+    return decorator
+
+# ============================================================================
+# ALMACENAMIENTO LOCAL (SQLITE)
+# ============================================================================
+
+_sqlite_local = threading.local()
+
+def get_sqlite_connection(path):
+    """Conexión SQLite en modo WAL, una por hilo y por proceso"""
+    connections = getattr(_sqlite_local, 'connections', None)
+    if connections is None or getattr(_sqlite_local, 'pid', None) != os.getpid():
+        connections = _sqlite_local.connections = {}
+        _sqlite_local.pid = os.getpid()
+    conn = connections.get(path)
+    if conn is None:
+        conn = sqlite3.connect(path, timeout=5, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        connections[path] = conn
+    return conn
 
 # ============================================================================
 # FUNCIONES DE WHATSAPP API
 # ============================================================================
 
+class WhatsAppClient:
+    """Cliente HTTP reutilizable para la Graph API de WhatsApp.
+
+    Mantiene un pool de conexiones keep-alive (opcionalmente HTTP/2) con los
+    headers de autenticación ya construidos y timeouts por llamada, para no
+    repetir el handshake TCP+TLS en cada mensaje saliente.
+    """
+
+    def __init__(self, token, phone_id, api_version=WHATSAPP_API_VERSION,
+                 timeout=WHATSAPP_TIMEOUT, connect_timeout=WHATSAPP_CONNECT_TIMEOUT,
+                 max_connections=WHATSAPP_MAX_CONNECTIONS, http2=WHATSAPP_HTTP2,
+                 transport=None):
+        self.url = f"https://graph.facebook.com/{api_version}/{phone_id}/messages"
+        self.headers = {
+            "Authorization": f"Bearer {token}",
+            "Content-Type": "application/json"
+        }
+        self.timeout = httpx.Timeout(timeout, connect=connect_timeout)
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_connections,
+            keepalive_expiry=30
+        )
+        self.http2 = http2 and self._http2_available()
+        self.transport = transport
+        self._client = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _http2_available():
+        """HTTP/2 requiere el paquete opcional h2"""
+        try:
+            import h2  # noqa: F401
+            return True
+        except ImportError:
+            print("Paquete h2 no instalado, usando HTTP/1.1 para WhatsApp")
+            return False
+
+    def _get_client(self):
+        """Crea el pool de forma perezosa, uno por proceso (seguro tras el fork de gunicorn)"""
+        pid = os.getpid()
+        if self._client is None or self._pid != pid:
+            with self._lock:
+                if self._client is None or self._pid != pid:
+                    self._client = httpx.Client(
+                        headers=self.headers,
+                        timeout=self.timeout,
+                        limits=self.limits,
+                        http2=self.http2,
+                        transport=self.transport
+                    )
+                    self._pid = pid
+        return self._client
+
+    def send(self, data):
+        """Envía un payload al endpoint de mensajes"""
+        try:
+            response = self._get_client().post(self.url, json=data)
+            return response.json()
+        except (httpx.HTTPError, ValueError) as e:
+            print(f"Error enviando mensaje de WhatsApp: {e}")
+            return {"error": str(e)}
+
+    def close(self):
+        """Cierra el pool de conexiones"""
+        with self._lock:
+            if self._client is not None:
+                self._client.close()
+                self._client = None
+
+whatsapp_client = WhatsAppClient(WHATSAPP_TOKEN, WHATSAPP_PHONE_ID)
+
 def send_whatsapp_message(phone_number, message):
     """Envía un mensaje de texto por WhatsApp"""
-    url = f"https://graph.facebook.com/v22.0/{WHATSAPP_PHONE_ID}/messages"
-    headers = {
-        "Authorization": f"Bearer {WHATSAPP_TOKEN}",
-        "Content-Type": "application/json"
-    }
     data = {
         "messaging_product": "whatsapp",
         "to": phone_number,
         "type": "text",
         "text": {"body": message}
     }
-    response = requests.post(url, headers=headers, json=data)
-    return response.json()
+    return whatsapp_client.send(data)
 
 def send_whatsapp_interactive_buttons(phone_number, body_text, buttons):
     """Envía mensaje con botones interactivos"""
-    url = f"https://graph.facebook.com/v22.0/{WHATSAPP_PHONE_ID}/messages"
-    headers = {
-        "Authorization": f"Bearer {WHATSAPP_TOKEN}",
-        "Content-Type": "application/json"
-    }
-    
     buttons_list = []
     for btn in buttons:
         buttons_list.append({
@@ -97,16 +451,10 @@ def send_whatsapp_interactive_buttons(phone_number, body_text, buttons):
             "action": {"buttons": buttons_list}
         }
     }
-    response = requests.post(url, headers=headers, json=data)
-    return response.json()
+    return whatsapp_client.send(data)
 
 def send_whatsapp_list(phone_number, body_text, button_text, sections):
     """Envía mensaje con lista de opciones"""
-    url = f"https://graph.facebook.com/v22.0/{WHATSAPP_PHONE_ID}/messages"
-    headers = {
-        "Authorization": f"Bearer {WHATSAPP_TOKEN}",
-        "Content-Type": "application/json"
-    }
     data = {
         "messaging_product": "whatsapp",
         "to": phone_number,
@@ -120,24 +468,470 @@ def send_whatsapp_list(phone_number, body_text, button_text, sections):
             }
         }
     }
-    response = requests.post(url, headers=headers, json=data)
-    return response.json()
+    return whatsapp_client.send(data)
+
+class StreamingReply:
+    """Agrupa un flujo de texto en mensajes de WhatsApp.
+
+    El primer mensaje sale con la primera oración completa; los siguientes
+    esperan un fin de párrafo o al menos `min_chars` caracteres terminados
+    en oración, y nunca antes de `min_interval` segundos desde el anterior
+    (el texto que llega mientras tanto se acumula). Con `max_messages - 1`
+    mensajes enviados el resto se junta en el último. Ningún mensaje supera
+    `max_length` caracteres: si lo pendiente al terminar no cabe en un solo
+    mensaje, `finish()` lo parte y es el único caso en que se supera
+    `max_messages` (el intervalo se respeta igual, esperando entre envíos).
+    """
+
+    SENTENCE_END = re.compile(r'[^\d\s][.!?…]+["»)]*(?=\s)')
+
+    def __init__(self, send, max_length=WHATSAPP_MAX_TEXT_LENGTH, min_chars=AI_STREAM_MIN_CHARS,
+                 min_interval=AI_STREAM_MIN_INTERVAL, max_messages=AI_STREAM_MAX_MESSAGES):
+        self.send = send
+        self.max_length = max_length
+        self.min_chars = min_chars
+        self.min_interval = min_interval
+        self.max_messages = max_messages
+        self.sent = 0
+        self._buffer = ""
+        self._last_sent = None
+        self._started = time.perf_counter()
+
+    def feed(self, text):
+        """Agrega texto del flujo y envía lo que ya esté listo"""
+        self._buffer += text
+        if not self._may_send():
+            return
+        if len(self._buffer) > self.max_length:
+            self._emit(self._split_point(self._buffer[:self.max_length]))
+            return
+        cut = self._buffer.rfind("\n\n")
+        if cut < 0 and (self.sent == 0 or len(self._buffer) >= self.min_chars):
+            ends = list(self.SENTENCE_END.finditer(self._buffer))
+            cut = ends[-1].end() if ends else -1
+        if cut > 0:
+            self._emit(cut)
+
+    def finish(self):
+        """Envía el texto pendiente al terminar el flujo"""
+        while self._buffer.strip():
+            wait = self._interval_remaining()
+            if wait > 0:
+                time.sleep(wait)
+            self._emit(min(len(self._buffer), self._split_point(self._buffer[:self.max_length])))
+
+    def _interval_remaining(self):
+        if self._last_sent is None:
+            return 0
+        return self.min_interval - (time.monotonic() - self._last_sent)
+
+    def _may_send(self):
+        if self.sent >= self.max_messages - 1:
+            return False
+        return self._interval_remaining() <= 0
+
+    def _split_point(self, window):
+        if len(window) < self.max_length:
+            return len(window)
+        for separator in ("\n\n", "\n", ". ", " "):
+            cut = window.rfind(separator)
+            if cut > 0:
+                return cut + len(separator)
+        return len(window)
+
+    def _emit(self, cut):
+        text, self._buffer = self._buffer[:cut].strip(), self._buffer[cut:].lstrip()
+        if not text:
+            return
+        if self.sent == 0:
+            metrics.observe("ai_stream_first_message_ms", (time.perf_counter() - self._started) * 1000)
+        self.send(text)
+        self.sent += 1
+        self._last_sent = time.monotonic()
+        metrics.incr("ai_stream_messages")
+
+# ============================================================================
+# CACHÉS
+# ============================================================================
+
+class LookupCache:
+    """Caché con TTL para consultas a la API, con caché negativa más corta.
+
+    Los resultados encontrados viven `ttl` segundos y los "no encontrado"
+    `negative_ttl`, para que un paciente recién registrado aparezca pronto.
+    Registra aciertos, fallos y la latencia ahorrada (según el promedio
+    observado de la llamada real).
+    """
+
+    def __init__(self, name, ttl, negative_ttl, max_size):
+        self.name = name
+        self._found = TTLCache(maxsize=max_size, ttl=ttl)
+        self._missing = TTLCache(maxsize=max_size, ttl=negative_ttl)
+        self._lock = threading.Lock()
+        self._avg_latency_ms = 0.0
+        metrics.register_gauge(f"{name}_cache", self.stats)
+
+    def get(self, key):
+        """Retorna (encontrado_en_cache, valor)"""
+        with self._lock:
+            if key in self._found:
+                value, hit = self._found[key], "hits"
+            elif key in self._missing:
+                value, hit = None, "negative_hits"
+            else:
+                value, hit = None, None
+            saved_ms = self._avg_latency_ms
+        if hit is None:
+            metrics.incr(f"{self.name}_cache_misses")
+            return False, None
+        metrics.incr(f"{self.name}_cache_{hit}")
+        metrics.incr(f"{self.name}_cache_saved_ms", saved_ms)
+        return True, value
+
+    def set(self, key, value):
+        with self._lock:
+            self._missing.pop(key, None)
+            self._found[key] = value
+
+    def set_missing(self, key):
+        with self._lock:
+            self._found.pop(key, None)
+            self._missing[key] = True
+
+    def invalidate(self, key):
+        with self._lock:
+            self._found.pop(key, None)
+            self._missing.pop(key, None)
+
+    def record_latency(self, elapsed_ms):
+        """Actualiza el promedio móvil de la latencia real"""
+        with self._lock:
+            if self._avg_latency_ms == 0:
+                self._avg_latency_ms = elapsed_ms
+            else:
+                self._avg_latency_ms = 0.9 * self._avg_latency_ms + 0.1 * elapsed_ms
+
+    def stats(self):
+        hits = metrics.get(f"{self.name}_cache_hits") + metrics.get(f"{self.name}_cache_negative_hits")
+        total = hits + metrics.get(f"{self.name}_cache_misses")
+        with self._lock:
+            return {
+                "size": len(self._found),
+                "negative_size": len(self._missing),
+                "hit_rate": hits / total if total else 0,
+                "avg_upstream_ms": round(self._avg_latency_ms, 2)
+            }
+
+cedula_cache = LookupCache("cedula", CEDULA_CACHE_TTL, CEDULA_NEGATIVE_TTL, CEDULA_CACHE_MAX_SIZE)
+
+class RefreshingCache:
+    """Datos casi estáticos servidos desde memoria (stale-while-revalidate).
+
+    `get()` nunca espera a la API salvo en la primera carga: si el valor
+    es más viejo que `interval` dispara un refresco en segundo plano y
+    responde con el dato anterior. Si el refresco falla se sigue sirviendo
+    el último valor bueno. `start()` agrega un refresco periódico y precarga
+    el valor al arrancar.
+    """
+
+    RETRY_AFTER = 5
+
+    def __init__(self, name, loader, interval=REFERENCE_CACHE_REFRESH, default=None):
+        self.name = name
+        self.loader = loader
+        self.interval = interval
+        self.default = default
+        self._value = None
+        self._loaded_at = None
+        self._last_attempt = 0
+        self._last_error = None
+        self._refreshing = False
+        self._periodic_pid = None
+        self._lock = threading.Lock()
+        metrics.register_gauge(f"{name}_cache", self.stats)
+
+    def get(self):
+        """Retorna el valor en caché, refrescándolo si está vencido"""
+        if self._periodic_pid is not None and self._periodic_pid != os.getpid():
+            self.start()
+        if self._loaded_at is None:
+            with self._lock:
+                if self._loaded_at is None and time.time() - self._last_attempt >= self.RETRY_AFTER:
+                    self.refresh()
+            if self._loaded_at is None:
+                metrics.incr(f"{self.name}_cache_unavailable")
+                return self.default
+        elif time.time() - self._loaded_at >= self.interval:
+            self._refresh_async()
+            metrics.incr(f"{self.name}_cache_stale_hits")
+            return self._value
+        metrics.incr(f"{self.name}_cache_hits")
+        return self._value
+
+    def refresh(self):
+        """Recarga el valor desde la API; conserva el anterior si falla"""
+        self._last_attempt = time.time()
+        start = time.perf_counter()
+        try:
+            value = self.loader()
+        except Exception as e:
+            print(f"Error refrescando caché {self.name}: {e}")
+            self._last_error = str(e)
+            metrics.incr(f"{self.name}_cache_refresh_errors")
+            return False
+        metrics.observe(f"{self.name}_cache_refresh_ms", (time.perf_counter() - start) * 1000)
+        self._value = value
+        self._loaded_at = time.time()
+        self._last_error = None
+        return True
+
+    def _refresh_async(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        def run():
+            try:
+                self.refresh()
+            finally:
+                self._refreshing = False
+
+        threading.Thread(target=run, name=f"{self.name}-refresh", daemon=True).start()
+
+    def start(self):
+        """Precarga y refresca periódicamente en un hilo propio del proceso"""
+        with self._lock:
+            if self._periodic_pid == os.getpid():
+                return
+            self._periodic_pid = os.getpid()
+
+        def loop():
+            while True:
+                self.refresh()
+                time.sleep(self.interval)
+
+        threading.Thread(target=loop, name=f"{self.name}-scheduler", daemon=True).start()
+
+    def stats(self):
+        return {
+            "loaded": self._loaded_at is not None,
+            "age_seconds": round(time.time() - self._loaded_at, 1) if self._loaded_at else None,
+            "last_error": self._last_error
+        }
+
+class SingleFlight:
+    """Agrupa llamadas idénticas concurrentes en una sola ejecución.
+
+    Mientras una llamada con cierta clave está en curso, las demás con la
+    misma clave esperan y reciben el mismo resultado (o la misma excepción).
+    """
+
+    class _Call:
+        __slots__ = ("done", "result", "error")
+
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self, name):
+        self.name = name
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self._Call()
+        if not leader:
+            metrics.incr(f"{self.name}_coalesced")
+            call.done.wait()
+        else:
+            try:
+                call.result = func()
+            except Exception as e:
+                call.error = e
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.done.set()
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+patient_api_flight = SingleFlight("patient_api")
 
 # ============================================================================
 # FUNCIONES DE BASE DE DATOS (API)
 # ============================================================================
 
+class PatientApiOverloaded(Exception):
+    """La API de pacientes alcanzó su límite de concurrencia"""
+
+class AdaptiveLimiter:
+    """Límite de concurrencia adaptativo (AIMD).
+
+    Cada respuesta rápida sube el límite en 1/límite (aprox. +1 por ventana);
+    una respuesta lenta lo reduce un 10% y un error o timeout lo divide a la
+    mitad. Quien no obtiene cupo en `queue_timeout` segundos es rechazado,
+    así un upstream lento no acapara todos los hilos del worker.
+    """
+
+    def __init__(self, name, initial, min_limit, max_limit, latency_target_ms, queue_timeout):
+        self.name = name
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_target_ms = latency_target_ms
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self._cond = threading.Condition()
+        metrics.register_gauge(f"{name}_concurrency", self.stats)
+
+    def acquire(self):
+        """Reserva un cupo; retorna False si no hubo cupo a tiempo"""
+        deadline = time.monotonic() + self.queue_timeout
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    metrics.incr(f"{self.name}_rejected")
+                    return False
+                self._cond.wait(remaining)
+            self.in_flight += 1
+            return True
+
+    def release(self, latency_ms, ok):
+        """Libera el cupo y ajusta el límite según el resultado"""
+        with self._cond:
+            self.in_flight -= 1
+            if not ok:
+                self.limit = max(self.min_limit, self.limit * 0.5)
+            elif latency_ms > self.latency_target_ms:
+                self.limit = max(self.min_limit, self.limit * 0.9)
+            else:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {"limit": round(self.limit, 2), "in_flight": self.in_flight}
+
+def _parse_timeouts(spec):
+    """Convierte "endpoint=segundos,..." en un dict"""
+    timeouts = {}
+    for item in spec.split(','):
+        if '=' in item:
+            endpoint, seconds = item.split('=', 1)
+            timeouts[endpoint.strip()] = float(seconds)
+    return timeouts
+
+class PatientApiClient:
+    """Cliente único para la API de pacientes.
+
+    Reutiliza un pool de conexiones con los headers ya construidos, aplica un
+    timeout por endpoint, limita la concurrencia con AdaptiveLimiter y agrupa
+    los GET idénticos simultáneos con SingleFlight.
+    """
+
+    def __init__(self, base_url=API_BASE_URL, api_key=API_KEY,
+                 default_timeout=PATIENT_API_TIMEOUT, timeouts=PATIENT_API_TIMEOUTS,
+                 max_connections=PATIENT_API_MAX_CONNECTIONS, transport=None):
+        self.base_url = base_url
+        self.headers = {
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json"
+        }
+        self.default_timeout = default_timeout
+        self.timeouts = _parse_timeouts(timeouts) if isinstance(timeouts, str) else dict(timeouts)
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_connections,
+            keepalive_expiry=30
+        )
+        self.transport = transport
+        self.limiter = AdaptiveLimiter(
+            "patient_api",
+            PATIENT_API_CONCURRENCY_INITIAL,
+            PATIENT_API_CONCURRENCY_MIN,
+            PATIENT_API_CONCURRENCY_MAX,
+            PATIENT_API_LATENCY_TARGET_MS,
+            PATIENT_API_QUEUE_TIMEOUT
+        )
+        self._client = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _get_client(self):
+        """Crea el pool de forma perezosa, uno por proceso"""
+        pid = os.getpid()
+        if self._client is None or self._pid != pid:
+            with self._lock:
+                if self._client is None or self._pid != pid:
+                    self._client = httpx.Client(
+                        base_url=self.base_url,
+                        headers=self.headers,
+                        limits=self.limits,
+                        transport=self.transport
+                    )
+                    self._pid = pid
+        return self._client
+
+    def timeout_for(self, endpoint):
+        return self.timeouts.get(endpoint, self.default_timeout)
+
+    def request(self, method, endpoint, path, **kwargs):
+        """Ejecuta una petición respetando el circuit breaker y el límite de concurrencia"""
+        breaker = circuit_breakers["patient_api"]
+        if not breaker.allow():
+            raise CircuitOpenError("API de pacientes no disponible")
+        if not self.limiter.acquire():
+            breaker.cancel()  # el rechazo local no indica falla del upstream
+            raise PatientApiOverloaded(f"Sin cupo para {endpoint}")
+        start = time.perf_counter()
+        ok = False
+        try:
+            response = self._get_client().request(
+                method, path, timeout=self.timeout_for(endpoint), **kwargs
+            )
+            ok = response.status_code < 500
+            return response
+        finally:
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            self.limiter.release(elapsed_ms, ok)
+            breaker.record(ok)
+            metrics.observe(f"patient_api_{endpoint}_ms", elapsed_ms)
+
+    def get(self, endpoint, path, params=None):
+        """GET; peticiones idénticas simultáneas comparten una sola llamada"""
+        key = (path, tuple(sorted((params or {}).items())))
+        return patient_api_flight.do(
+            key, lambda: self.request("GET", endpoint, path, params=params)
+        )
+
+    def post(self, endpoint, path, data):
+        return self.request("POST", endpoint, path, json=data)
+
+patient_api = PatientApiClient()
+
 def validate_cedula(cedula):
     """Valida si la cédula existe en la base de datos"""
+    cached, patient = cedula_cache.get(cedula)
+    if cached:
+        return patient
     try:
-        headers = {"Authorization": f"Bearer {API_KEY}"}
-        response = requests.get(
-            f"{API_BASE_URL}/pacientes/cedula/{cedula}",
-            headers=headers,
-            timeout=10
-        )
+        start = time.perf_counter()
+        response = patient_api.get("validate_cedula", f"/pacientes/cedula/{cedula}")
+        cedula_cache.record_latency((time.perf_counter() - start) * 1000)
         if response.status_code == 200:
-            return response.json()
+            patient = response.json()
+            cedula_cache.set(cedula, patient)
+            return patient
+        if response.status_code == 404:
+            cedula_cache.set_missing(cedula)
         return None
     except Exception as e:
         print(f"Error validando cédula: {e}")
@@ -146,148 +940,905 @@ def validate_cedula(cedula):
 def create_patient(cedula, nombre, apellidos):
     """Crea un nuevo paciente en la base de datos"""
     try:
-        headers = {
-            "Authorization": f"Bearer {API_KEY}",
-            "Content-Type": "application/json"
-        }
         data = {
             "cedula": cedula,
             "nombre": nombre,
             "apellidos": apellidos,
             "fecha_registro": datetime.now().isoformat()
         }
-        response = requests.post(
-            f"{API_BASE_URL}/pacientes",
-            headers=headers,
-            json=data,
-            timeout=10
-        )
+        response = patient_api.post("create_patient", "/pacientes", data)
+        # El 404 cacheado ya no es válido para esta cédula
+        cedula_cache.invalidate(cedula)
         return response.json()
     except Exception as e:
         print(f"Error creando paciente: {e}")
         return None
 
+def fetch_appointments():
+    """Consulta las citas disponibles en la API"""
+    response = patient_api.get("appointments", "/citas/disponibles")
+    response.raise_for_status()
+    return response.json()
+
+def fetch_contact_phones():
+    """Consulta los teléfonos de contacto en la API"""
+    response = patient_api.get("contact_phones", "/contactos/telefonos")
+    response.raise_for_status()
+    return response.json()
+
+appointments_cache = RefreshingCache("appointments", fetch_appointments, default=[])
+contact_phones_cache = RefreshingCache("contact_phones", fetch_contact_phones, default=[])
+
 def get_appointments():
     """Obtiene las citas disponibles"""
-    try:
-        headers = {"Authorization": f"Bearer {API_KEY}"}
-        response = requests.get(
-            f"{API_BASE_URL}/citas/disponibles",
-            headers=headers,
-            timeout=10
-        )
-        if response.status_code == 200:
-            return response.json()
-        return []
-    except Exception as e:
-        print(f"Error obteniendo citas: {e}")
-        return []
+    return appointments_cache.get()
 
 def get_contact_phones():
     """Obtiene los teléfonos de contacto"""
-    try:
-        headers = {"Authorization": f"Bearer {API_KEY}"}
-        response = requests.get(
-            f"{API_BASE_URL}/contactos/telefonos",
-            headers=headers,
-            timeout=10
-        )
-        if response.status_code == 200:
-            return response.json()
-        return []
-    except Exception as e:
-        print(f"Error obteniendo teléfonos: {e}")
-        return []
+    return contact_phones_cache.get()
 
 def save_medical_image(patient_id, image_url, image_type):
     """Guarda una imagen médica en la base de datos"""
     try:
-        headers = {
-            "Authorization": f"Bearer {API_KEY}",
-            "Content-Type": "application/json"
-        }
         data = {
             "patient_id": patient_id,
             "image_url": image_url,
             "image_type": image_type,
             "fecha": datetime.now().isoformat()
         }
-        response = requests.post(
-            f"{API_BASE_URL}/estudios",
-            headers=headers,
-            json=data,
-            timeout=10
-        )
-        return response.json()
+        return submit_patient_write("medical_image", "/estudios", data)
     except Exception as e:
         print(f"Error guardando imagen: {e}")
         return None
 
+# ============================================================================
+# ESCRITURAS DIFERIDAS (WRITE-BEHIND)
+# ============================================================================
+
+class WriteBehindSpool:
+    """Spool durable en SQLite (WAL) para escrituras que el usuario no espera.
+
+    `enqueue` solo inserta una fila local; un hilo en segundo plano envía los
+    registros por lotes a la API de pacientes. Los errores 5xx y de red se
+    reintentan con backoff exponencial; los 4xx o los que superan el tiempo
+    máximo de reintentos quedan marcados como `dead` para revisión manual. Cada lote se
+    reserva con un lease, así varios workers pueden compartir el archivo.
+
+    El límite para rendirse es de tiempo (`max_age_hours` desde que se
+    encoló), no de intentos: una caída larga de la API no descarta nada.
+    Los rechazos locales (circuito abierto, sin cupo) no llegan a la API y
+    solo reprograman el registro, sin contar como intento.
+    """
+
+    LEASE_SECONDS = 60
+    MAX_BACKOFF = 300
+    LOCAL_REJECT_DELAY = 5
+
+    def __init__(self, path=SPOOL_DB_PATH, batch_size=SPOOL_BATCH_SIZE,
+                 flush_interval=SPOOL_FLUSH_INTERVAL, max_age_hours=SPOOL_MAX_AGE_HOURS):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_age = max_age_hours * 3600
+        self._ready = False
+        self._flusher_pid = None
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+        metrics.register_gauge("write_spool", self.stats)
+
+    def _conn(self):
+        conn = get_sqlite_connection(self.path)
+        if not self._ready:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS spool ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, endpoint TEXT NOT NULL, "
+                "path TEXT NOT NULL, payload TEXT NOT NULL, "
+                "attempts INTEGER NOT NULL DEFAULT 0, next_attempt REAL NOT NULL, "
+                "status TEXT NOT NULL DEFAULT 'pending', last_error TEXT, created_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_spool_pending ON spool (status, next_attempt)")
+            self._ready = True
+        return conn
+
+    def enqueue(self, endpoint, path, payload):
+        """Guarda la escritura en el spool y despierta al flusher"""
+        now = time.time()
+        self._conn().execute(
+            "INSERT INTO spool (endpoint, path, payload, next_attempt, created_at) VALUES (?, ?, ?, ?, ?)",
+            (endpoint, path, json.dumps(payload), now, now)
+        )
+        metrics.incr("write_spool_enqueued")
+        self.start()
+        self._wakeup.set()
+
+    def _claim_batch(self):
+        conn = self._conn()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute(
+                "SELECT id, endpoint, path, payload, attempts, created_at FROM spool "
+                "WHERE status = 'pending' AND next_attempt <= ? ORDER BY id LIMIT ?",
+                (now, self.batch_size)
+            ).fetchall()
+            if rows:
+                conn.executemany(
+                    "UPDATE spool SET next_attempt = ? WHERE id = ?",
+                    [(now + self.LEASE_SECONDS, row[0]) for row in rows]
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return rows
+
+    def flush_once(self):
+        """Envía un lote; retorna cuántos registros se procesaron"""
+        rows = self._claim_batch()
+        conn = self._conn()
+        for row_id, endpoint, path, payload, attempts, created_at in rows:
+            error, retry = None, False
+            try:
+                response = patient_api.post(endpoint, path, json.loads(payload))
+            except (CircuitOpenError, PatientApiOverloaded) as e:
+                conn.execute(
+                    "UPDATE spool SET next_attempt = ?, last_error = ? WHERE id = ?",
+                    (time.time() + self.LOCAL_REJECT_DELAY, str(e), row_id)
+                )
+                metrics.incr("write_spool_deferred")
+                continue
+            except Exception as e:
+                error, retry = str(e), True
+            else:
+                if response.status_code >= 500 or response.status_code == 429:
+                    error, retry = f"HTTP {response.status_code}", True
+                elif response.status_code >= 400:
+                    error = f"HTTP {response.status_code}"
+
+            if error is None:
+                conn.execute("DELETE FROM spool WHERE id = ?", (row_id,))
+                metrics.incr("write_spool_flushed")
+            elif retry and time.time() - created_at < self.max_age:
+                delay = min(self.MAX_BACKOFF, 2 ** min(attempts, 16))
+                conn.execute(
+                    "UPDATE spool SET attempts = ?, next_attempt = ?, last_error = ? WHERE id = ?",
+                    (attempts + 1, time.time() + delay, error, row_id)
+                )
+                metrics.incr("write_spool_retries")
+            else:
+                print(f"Escritura diferida descartada ({endpoint}): {error}")
+                conn.execute(
+                    "UPDATE spool SET status = 'dead', attempts = ?, last_error = ? WHERE id = ?",
+                    (attempts + 1, error, row_id)
+                )
+                metrics.incr("write_spool_dead")
+        return len(rows)
+
+    def start(self):
+        """Arranca el flusher en segundo plano, uno por proceso"""
+        if self._flusher_pid == os.getpid():
+            return
+        with self._lock:
+            if self._flusher_pid == os.getpid():
+                return
+            self._flusher_pid = os.getpid()
+        threading.Thread(target=self._run, name="write-spool-flusher", daemon=True).start()
+
+    def _run(self):
+        while True:
+            try:
+                if self.flush_once() == self.batch_size:
+                    continue
+            except Exception as e:
+                print(f"Error vaciando spool de escrituras: {e}")
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+
+    def stats(self):
+        if not self._ready and not os.path.exists(self.path):
+            return {"depth": 0, "dead": 0}
+        counts = dict(self._conn().execute(
+            "SELECT status, COUNT(*) FROM spool GROUP BY status"
+        ).fetchall())
+        return {"depth": counts.get("pending", 0), "dead": counts.get("dead", 0)}
+
+write_spool = WriteBehindSpool()
+
+def submit_patient_write(endpoint, path, data):
+    """Escritura no crítica: al spool si está activo, si no directo a la API"""
+    if WRITE_BEHIND_ENABLED:
+        try:
+            write_spool.enqueue(endpoint, path, data)
+            return {"status": "queued"}
+        except sqlite3.Error as e:
+            print(f"Error escribiendo en el spool, enviando directo: {e}")
+    response = patient_api.post(endpoint, path, data)
+    return response.json()
+
 # ============================================================================
 # FUNCIONES DE IA (CHATGPT/CLAUDE)
 # ============================================================================
 
-def get_ai_response(question, context="ortopedia"):
-    """Obtiene respuesta de IA especializada en ortopedia"""
+AI_FALLBACK_MESSAGE = "Disculpa, no puedo procesar tu consulta en este momento."
+
+# Prioridades de la cola de la IA (menor = antes)
+LLM_PRIORITY_CHAT = 0
+LLM_PRIORITY_BACKGROUND = 1
+
+class LLMOverloaded(Overloaded):
+    """No hubo cupo para llamar al modelo antes del plazo"""
+
+class PriorityLimiter:
+    """Límite fijo de llamadas simultáneas con cola por prioridad y plazo.
+
+    Los cupos libres se entregan a la prioridad más baja y, a igual
+    prioridad, por orden de llegada. Quien no obtiene cupo antes de
+    `timeout` segundos sale de la cola y `acquire` retorna False.
+    """
+
+    def __init__(self, name, max_in_flight):
+        self.name = name
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self._waiting = []
+        self._tickets = itertools.count()
+        self._cond = threading.Condition()
+        metrics.register_gauge(f"{name}_queue", self.stats)
+
+    def acquire(self, priority, timeout):
+        """Espera un cupo en la cola; retorna False si vence el plazo"""
+        start = time.monotonic()
+        deadline = start + timeout
+        with self._cond:
+            ticket = (priority, next(self._tickets))
+            heapq.heappush(self._waiting, ticket)
+            while self.in_flight >= self.max_in_flight or self._waiting[0] != ticket:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._waiting.remove(ticket)
+                    heapq.heapify(self._waiting)
+                    self._cond.notify_all()
+                    metrics.incr(f"{self.name}_queue_timeouts")
+                    metrics.observe(f"{self.name}_queue_wait_ms", (time.monotonic() - start) * 1000)
+                    return False
+                self._cond.wait(remaining)
+            heapq.heappop(self._waiting)
+            self.in_flight += 1
+            # El siguiente de la cola puede tener cupo también
+            self._cond.notify_all()
+        metrics.observe(f"{self.name}_queue_wait_ms", (time.monotonic() - start) * 1000)
+        return True
+
+    def release(self):
+        """Libera un cupo"""
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {"max_in_flight": self.max_in_flight, "in_flight": self.in_flight, "queued": len(self._waiting)}
+
+llm_limiter = PriorityLimiter("llm", AI_MAX_IN_FLIGHT)
+llm_fallback_limiter = PriorityLimiter("llm_fallback", AI_FALLBACK_MAX_IN_FLIGHT)
+
+_openai_client = None
+
+def get_openai_client():
+    """Cliente de OpenAI compartido, con timeout por llamada"""
+    global _openai_client
+    if _openai_client is None:
+        import openai  # Para ChatGPT
+        # from anthropic import Anthropic  # Para Claude (alternativa)
+        # openai 1.3 pasa `proxies` a httpx.Client, que httpx 0.28 ya no acepta;
+        # con un cliente HTTP propio se evita ese camino
+        _openai_client = openai.OpenAI(
+            api_key=OPENAI_API_KEY,
+            timeout=OPENAI_TIMEOUT,
+            max_retries=0,
+            http_client=httpx.Client(timeout=OPENAI_TIMEOUT)
+        )
+    return _openai_client
+
+def _create_completion(limiter, model, priority, request):
+    if not limiter.acquire(priority, AI_QUEUE_TIMEOUT):
+        raise LLMOverloaded(f"Sin cupo para {model}")
+    try:
+        return get_openai_client().chat.completions.create(model=model, **request)
+    except Exception:
+        limiter.release()
+        raise
+
+@contextmanager
+def chat_completion(priority=LLM_PRIORITY_CHAT, **request):
+    """Consulta de chat con cupo global; el cupo se mantiene hasta salir del bloque.
+
+    Si no hay cupo a tiempo, o el modelo principal responde 429 o timeout,
+    se intenta una vez con AI_FALLBACK_MODEL (con su propio límite).
+    """
+    import openai
+    limiter = llm_limiter
+    try:
+        response = _create_completion(llm_limiter, AI_MODEL, priority, request)
+    except (LLMOverloaded, openai.RateLimitError, openai.APITimeoutError) as e:
+        if not AI_FALLBACK_MODEL:
+            raise
+        print(f"Usando modelo de respaldo {AI_FALLBACK_MODEL}: {type(e).__name__}")
+        metrics.incr("llm_fallbacks")
+        limiter = llm_fallback_limiter
+        response = _create_completion(llm_fallback_limiter, AI_FALLBACK_MODEL, priority, request)
+    try:
+        yield response
+    finally:
+        limiter.release()
+
+# Sin palabras de polaridad ("no", "sin", "sí"): invierten el sentido de la pregunta
+SPANISH_STOPWORDS = frozenset("""
+a al algo como con de del el ella en es esta este esto la las le les lo los me mi mis
+muy o para pero por que se su sus te tengo tiene tu un una uno unos unas y ya yo
+""".split())
+
+def normalize_question(text):
+    """Forma canónica de una pregunta: sin tildes, puntuación ni stopwords"""
+    folded = unicodedata.normalize('NFKD', text.lower())
+    folded = ''.join(ch for ch in folded if not unicodedata.combining(ch))
+    words = re.findall(r'[a-z0-9]+', folded)
+    return ' '.join(word for word in words if word not in SPANISH_STOPWORDS)
+
+class AIResponseCache:
+    """Caché de respuestas de IA por pregunta normalizada, con TTL y tamaño máximo.
+
+    Opcionalmente busca preguntas casi idénticas con MinHash sobre trigramas
+    de caracteres; los candidatos se obtienen por LSH (bandas de la firma) y
+    se aceptan si su similitud estimada supera `similarity`.
+    """
+
+    NUM_HASHES = 64
+    BANDS = 16
+
+    def __init__(self, ttl=AI_CACHE_TTL, max_size=AI_CACHE_MAX_SIZE,
+                 near_duplicates=AI_CACHE_NEAR_DUPLICATES, similarity=AI_CACHE_SIMILARITY):
+        self.near_duplicates = near_duplicates
+        self.similarity = similarity
+        self._answers = TTLCache(maxsize=max_size, ttl=ttl)
+        self._signatures = {}
+        self._buckets = {}
+        self._lock = threading.Lock()
+        metrics.register_gauge("ai_cache", self.stats)
+
+    # Permutaciones (a*h + b) mod p independientes sobre un hash base de 64 bits
+    _PRIME = (1 << 61) - 1
+    _PERMUTATIONS = [tuple(random.Random(seed).sample(range(1, (1 << 61) - 1), 2)) for seed in range(NUM_HASHES)]
+    # Palabras que invierten el sentido: dos preguntas que difieren en ellas nunca son "casi iguales"
+    POLARITY_WORDS = frozenset(("no", "sin", "si", "nunca", "tampoco", "ni"))
+
+    def _signature(self, key):
+        padded = f" {key} "
+        shingles = {
+            int.from_bytes(hashlib.blake2b(padded[i:i + 3].encode('utf-8'), digest_size=8).digest(), 'big')
+            for i in range(max(1, len(padded) - 2))
+        }
+        return tuple(
+            min((a * h + b) % self._PRIME for h in shingles)
+            for a, b in self._PERMUTATIONS
+        )
+
+    @classmethod
+    def _polarity(cls, key):
+        return frozenset(word for word in key.split() if word in cls.POLARITY_WORDS)
+
+    def _bands(self, signature):
+        rows = self.NUM_HASHES // self.BANDS
+        return [(band, signature[band * rows:(band + 1) * rows]) for band in range(self.BANDS)]
+
+    def get(self, question):
+        key = normalize_question(question)
+        with self._lock:
+            answer = self._answers.get(key)
+            if answer is None and self.near_duplicates and key:
+                answer = self._find_similar(key)
+                if answer is not None:
+                    metrics.incr("ai_cache_near_hits")
+                    return answer
+        metrics.incr("ai_cache_hits" if answer is not None else "ai_cache_misses")
+        return answer
+
+    def _find_similar(self, key):
+        signature = self._signature(key)
+        candidates = set()
+        for band in self._bands(signature):
+            candidates |= self._buckets.get(band, set())
+        best, best_score = None, self.similarity
+        polarity = self._polarity(key)
+        for candidate in candidates:
+            if candidate not in self._answers:
+                self._forget(candidate)
+                continue
+            if self._polarity(candidate) != polarity:
+                continue
+            other = self._signatures[candidate]
+            score = sum(a == b for a, b in zip(signature, other)) / self.NUM_HASHES
+            if score >= best_score:
+                best, best_score = candidate, score
+        return self._answers.get(best) if best else None
+
+    def _forget(self, key):
+        signature = self._signatures.pop(key, None)
+        if signature:
+            for band in self._bands(signature):
+                bucket = self._buckets.get(band)
+                if bucket:
+                    bucket.discard(key)
+                    if not bucket:
+                        del self._buckets[band]
+
+    def set(self, question, answer):
+        key = normalize_question(question)
+        if not key:
+            return
+        with self._lock:
+            self._answers[key] = answer
+            if self.near_duplicates and key not in self._signatures:
+                if len(self._signatures) > 2 * self._answers.maxsize:
+                    for stale in [k for k in self._signatures if k not in self._answers]:
+                        self._forget(stale)
+                signature = self._signature(key)
+                self._signatures[key] = signature
+                for band in self._bands(signature):
+                    self._buckets.setdefault(band, set()).add(key)
+
+    def stats(self):
+        hits = metrics.get("ai_cache_hits") + metrics.get("ai_cache_near_hits")
+        total = hits + metrics.get("ai_cache_misses")
+        with self._lock:
+            return {"size": len(self._answers), "hit_rate": hits / total if total else 0}
+
+ai_response_cache = AIResponseCache()
+
+_token_encoder = None
+
+def count_tokens(text):
+    """Tokens de un texto: exactos con tiktoken (opcional), si no una estimación"""
+    global _token_encoder
+    if _token_encoder is None:
+        try:
+            import tiktoken
+            _token_encoder = tiktoken.encoding_for_model("gpt-4")
+        except ImportError:
+            print("Paquete tiktoken no instalado, estimando tokens por longitud")
+            _token_encoder = False
+        except Exception as e:
+            print(f"Error cargando tiktoken: {e}")
+            _token_encoder = False
+    if _token_encoder:
+        return len(_token_encoder.encode(text))
+    # En español un token ronda los 3-4 caracteres; se sobreestima a propósito
+    return len(text) // 3 + 1
+
+def conversation_context(session, max_tokens=None):
+    """Mensajes previos para la IA: resumen (si hay) y los turnos recientes que caben en el presupuesto"""
+    if max_tokens is None:
+        max_tokens = AI_CONTEXT_MAX_TOKENS
+    messages = []
+    summary = session.data.get("context_summary")
+    if summary:
+        messages.append({"role": "system", "content": f"Resumen de la conversación previa: {summary}"})
+        max_tokens -= count_tokens(summary)
+    turns, _ = session.recent_turns(max(0, max_tokens))
+    messages.extend(turns)
+    return messages
+
+def record_conversation_turns(phone_number, question, answer):
+    """Guarda la pregunta y la respuesta en el historial; resume lo que ya no cabe"""
+    def apply(session):
+        session.add_turn("user", question)
+        session.add_turn("assistant", answer)
+
+    session = session_store.update(phone_number, apply)
+    if AI_CONTEXT_SUMMARIZE:
+        compact_conversation(phone_number, session)
+
+def compact_conversation(phone_number, session, max_tokens=None):
+    """Reemplaza los turnos que no caben en el presupuesto por un resumen"""
+    if max_tokens is None:
+        max_tokens = AI_CONTEXT_MAX_TOKENS
+    summary = session.data.get("context_summary")
+    budget = max_tokens - (count_tokens(summary) if summary else 0) - AI_CONTEXT_SUMMARY_TOKENS
+    _, overflow = session.recent_turns(max(0, budget))
+    if not overflow:
+        return
+    new_summary = summarize_conversation(summary, session.conversation_history[:overflow])
+    if new_summary is None:
+        # Sin resumen los turnos antiguos simplemente quedan fuera del contexto
+        return
+
+    def apply(s):
+        s.drop_oldest(overflow)
+        s.data["context_summary"] = new_summary
+
+    session_store.update(phone_number, apply)
+    metrics.incr("ai_context_summaries")
+
+@protected_by("openai", fallback=None)
+def summarize_conversation(summary, turns):
+    """Condensa el resumen anterior y los turnos dados en un nuevo resumen"""
+    transcript = "\n".join(f"{turn['role']}: {turn['content']}" for turn in turns)
+    if summary:
+        transcript = f"Resumen anterior: {summary}\n{transcript}"
     try:
-        system_prompt = """Eres un asistente médico especializado en ortopedia.
+        with chat_completion(
+            priority=LLM_PRIORITY_BACKGROUND,
+            messages=[
+                {"role": "system", "content": "Resume en español, en pocas frases, los datos clínicos y "
+                                              "las dudas del paciente en esta conversación de ortopedia."},
+                {"role": "user", "content": transcript}
+            ],
+            max_tokens=AI_CONTEXT_SUMMARY_TOKENS,
+            temperature=0
+        ) as response:
+            return response.choices[0].message.content
+    except LLMOverloaded:
+        raise
+    except Exception as e:
+        print(f"Error resumiendo conversación: {e}")
+        return None
+
+def get_ai_response(question, context="ortopedia", history=None):
+    """Obtiene respuesta de IA especializada en ortopedia.
+
+    `history` son los mensajes previos de la conversación; con historial la
+    respuesta depende del contexto y no pasa por la caché.
+    """
+    if history:
+        metrics.incr("ai_context_requests")
+        return ask_openai(question, history)
+    cached = ai_response_cache.get(question)
+    if cached is not None:
+        return cached
+    answer = ask_openai(question)
+    if answer != AI_FALLBACK_MESSAGE:
+        ai_response_cache.set(question, answer)
+    return answer
+
+AI_SYSTEM_PROMPT = """Eres un asistente médico especializado en ortopedia.
         Proporciona respuestas precisas, profesionales y basadas en evidencia médica.
         Si la pregunta está fuera de tu especialidad, indícalo claramente.
         Siempre recomienda consultar con un médico para diagnósticos definitivos."""
+
+def _chat_request(question, history=None, **kwargs):
+    """Parámetros comunes de la consulta de chat a OpenAI"""
+    return dict(
+        messages=[
+            {"role": "system", "content": AI_SYSTEM_PROMPT},
+            *(history or []),
+            {"role": "user", "content": question}
+        ],
+        max_tokens=500,
+        temperature=0.7,
+        **kwargs
+    )
+
+@protected_by("openai", fallback=AI_FALLBACK_MESSAGE)
+def ask_openai(question, history=None):
+    """Consulta a OpenAI sin caché"""
+    try:
+        with chat_completion(**_chat_request(question, history)) as response:
+            return response.choices[0].message.content
         
-        response = openai.ChatCompletion.create(
-            model="gpt-4",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": question}
-            ],
-            max_tokens=500,
-            temperature=0.7
-        )
-        return response.choices[0].message.content
-        
+    except LLMOverloaded:
+        raise
     except Exception as e:
         print(f"Error con IA: {e}")
-        return "Disculpa, no puedo procesar tu consulta en este momento."
+        return AI_FALLBACK_MESSAGE
+
+@protected_by("openai", fallback=AI_FALLBACK_MESSAGE)
+def stream_openai(question, on_text, history=None):
+    """Consulta a OpenAI en modo streaming, pasando cada fragmento a `on_text`"""
+    parts = []
+    try:
+        with chat_completion(**_chat_request(question, history, stream=True)) as stream:
+            for chunk in stream:
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                if delta:
+                    parts.append(delta)
+                    on_text(delta)
+    except LLMOverloaded:
+        raise
+    except Exception as e:
+        print(f"Error con IA (streaming): {e}")
+        return AI_FALLBACK_MESSAGE
+    return "".join(parts) or AI_FALLBACK_MESSAGE
+
+def stream_ai_response(phone_number, question, history=None):
+    """Envía la respuesta de IA por WhatsApp a medida que se genera"""
+    cached = None if history else ai_response_cache.get(question)
+    if cached is not None:
+        send_whatsapp_message(phone_number, cached)
+        return cached
+    if history:
+        metrics.incr("ai_context_requests")
+    reply = StreamingReply(lambda text: send_whatsapp_message(phone_number, text))
+    answer = stream_openai(question, reply.feed, history)
+    reply.finish()
+    if answer == AI_FALLBACK_MESSAGE:
+        send_whatsapp_message(phone_number, AI_FALLBACK_MESSAGE)
+    elif not history:
+        ai_response_cache.set(question, answer)
+    return answer
 
 # ============================================================================
-# FUNCIONES DE ZOOM API
+# PREGUNTAS FRECUENTES (FAQ)
 # ============================================================================
 
-def create_zoom_meeting(topic, duration=60, start_time=None):
-    """Crea una reunión en Zoom"""
-    try:
-        import base64
-        
-        token_url = "https://zoom.us/oauth/token"
-        token_data = {
-            "grant_type": "account_credentials",
-            "account_id": ZOOM_ACCOUNT_ID
+class FAQIndex:
+    """Índice BM25 inmutable sobre las preguntas de un corpus de FAQ.
+
+    Cada pregunta de ejemplo es un documento; los pesos BM25 se guardan
+    como listas invertidas de NumPy (término -> documentos, pesos), así
+    una consulta solo suma los vectores de sus términos.
+
+    La confianza combina (media geométrica) cuánto de la consulta cubre el
+    documento y cuánto del documento cubre la consulta, y exige al menos
+    MIN_MATCHED_TERMS términos en común: una consulta genérica de una o dos
+    palabras ("me duele") no basta para dar una respuesta médica enlatada.
+    """
+
+    K1 = 1.5
+    B = 0.75
+    MIN_MATCHED_TERMS = 2
+
+    def __init__(self, entries):
+        import numpy as np
+        self.entries = entries
+        docs, owners = [], []
+        for position, entry in enumerate(entries):
+            for question in entry["preguntas"]:
+                docs.append(normalize_question(question).split())
+                owners.append(position)
+        self.owners = np.array(owners, dtype=np.int32)
+        self.num_docs = len(docs)
+        lengths = np.array([len(doc) for doc in docs], dtype=np.float32)
+        avg_length = lengths.mean() if self.num_docs else 1.0
+
+        postings = {}
+        for doc_id, doc in enumerate(docs):
+            for term in set(doc):
+                postings.setdefault(term, []).append((doc_id, doc.count(term)))
+
+        self.postings = {}
+        self.idf = {}
+        self.doc_norms = np.zeros(self.num_docs, dtype=np.float32)
+        for term, hits in postings.items():
+            doc_ids = np.array([doc_id for doc_id, _ in hits], dtype=np.int32)
+            tf = np.array([count for _, count in hits], dtype=np.float32)
+            idf = float(np.log(1 + (self.num_docs - len(hits) + 0.5) / (len(hits) + 0.5)))
+            norm = self.K1 * (1 - self.B + self.B * lengths[doc_ids] / avg_length)
+            weights = (idf * tf * (self.K1 + 1) / (tf + norm)).astype(np.float32)
+            self.postings[term] = (doc_ids, weights)
+            self.idf[term] = idf
+            # Puntaje del documento consigo mismo, para medir cuánto de él cubre la consulta
+            self.doc_norms[doc_ids] += weights
+        # Un término que no aparece en el corpus pesa como el más raro posible
+        self.unknown_idf = float(np.log(1 + (self.num_docs + 0.5) / 0.5))
+
+    def search(self, question):
+        """Retorna (entrada, confianza entre 0 y 1) de la mejor coincidencia"""
+        import numpy as np
+        terms = set(normalize_question(question).split())
+        if not terms or not self.num_docs:
+            return None, 0.0
+        scores = np.zeros(self.num_docs, dtype=np.float32)
+        matched = np.zeros(self.num_docs, dtype=np.int32)
+        for term in terms:
+            posting = self.postings.get(term)
+            if posting is not None:
+                scores[posting[0]] += posting[1]
+                matched[posting[0]] += 1
+        # Cobertura de la consulta: contra un documento que contiene cada término una vez
+        ideal = sum(self.idf.get(term, self.unknown_idf) for term in terms)
+        query_coverage = np.minimum(1.0, scores / ideal)
+        doc_coverage = np.divide(scores, self.doc_norms, out=np.zeros_like(scores), where=self.doc_norms > 0)
+        confidence = np.sqrt(query_coverage * doc_coverage)
+        confidence[matched < self.MIN_MATCHED_TERMS] = 0.0
+        best = int(confidence.argmax())
+        return self.entries[self.owners[best]], float(confidence[best])
+
+class FAQRetriever:
+    """Responde preguntas frecuentes desde un archivo JSON local.
+
+    El índice se construye al arrancar y se recarga en segundo plano cuando
+    cambia la fecha de modificación del archivo (revisada como mucho cada
+    `reload_interval` segundos); mientras tanto se sigue usando el anterior.
+    """
+
+    def __init__(self, path=FAQ_FILE, threshold=FAQ_THRESHOLD, reload_interval=FAQ_RELOAD_INTERVAL):
+        self.path = path
+        self.threshold = threshold
+        self.reload_interval = reload_interval
+        self._index = None
+        self._mtime = None
+        self._checked_at = 0
+        self._last_error = None
+        self._reloading = False
+        self._lock = threading.Lock()
+        metrics.register_gauge("faq", self.stats)
+
+    def load(self):
+        """Construye el índice desde el archivo; conserva el anterior si falla"""
+        start = time.perf_counter()
+        try:
+            mtime = os.path.getmtime(self.path)
+            with open(self.path, encoding='utf-8') as f:
+                entries = json.load(f)
+            index = FAQIndex(entries)
+        except Exception as e:
+            print(f"Error cargando FAQ {self.path}: {e}")
+            self._last_error = str(e)
+            metrics.incr("faq_load_errors")
+            return False
+        self._index = index
+        self._mtime = mtime
+        self._last_error = None
+        metrics.observe("faq_build_ms", (time.perf_counter() - start) * 1000)
+        return True
+
+    def _maybe_reload(self):
+        now = time.time()
+        if now - self._checked_at < self.reload_interval:
+            return
+        with self._lock:
+            if self._reloading or now - self._checked_at < self.reload_interval:
+                return
+            self._checked_at = now
+            try:
+                changed = os.path.getmtime(self.path) != self._mtime
+            except OSError:
+                return
+            if not changed:
+                return
+            self._reloading = True
+
+        def run():
+            try:
+                self.load()
+            finally:
+                self._reloading = False
+
+        threading.Thread(target=run, name="faq-reload", daemon=True).start()
+
+    def answer(self, question):
+        """Respuesta de la FAQ si la confianza supera el umbral; si no, None"""
+        if self._index is None:
+            with self._lock:
+                if self._index is None and self._checked_at == 0:
+                    self._checked_at = time.time()
+                    if os.path.exists(self.path):
+                        self.load()
+        else:
+            self._maybe_reload()
+        index = self._index
+        if index is None:
+            return None
+        start = time.perf_counter()
+        entry, confidence = index.search(question)
+        metrics.observe("faq_query_ms", (time.perf_counter() - start) * 1000)
+        if entry is None or confidence < self.threshold:
+            metrics.incr("faq_misses")
+            return None
+        metrics.incr("faq_hits")
+        return entry["respuesta"]
+
+    def stats(self):
+        index = self._index
+        return {
+            "entries": len(index.entries) if index else 0,
+            "documents": index.num_docs if index else 0,
+            "last_error": self._last_error
         }
-        
+
+faq_retriever = FAQRetriever()
+
+# ============================================================================
+# FUNCIONES DE ZOOM API
+# ============================================================================
+
+class ZoomTokenManager:
+    """Caché del access token OAuth de Zoom (account credentials).
+
+    Reutiliza el token hasta su `expires_in`. Dentro de los últimos
+    `refresh_margin` segundos lo renueva en segundo plano mientras sigue
+    entregando el actual; si ya venció, un solo hilo lo renueva y los demás
+    esperan ese mismo resultado.
+    """
+
+    TOKEN_URL = "https://zoom.us/oauth/token"
+
+    def __init__(self, refresh_margin=ZOOM_TOKEN_REFRESH_MARGIN):
+        self.refresh_margin = refresh_margin
+        self._token = None
+        self._expires_at = 0
+        self._refresh_lock = threading.Lock()
+        self._refreshing = False
+
+    def _fetch(self):
+        """Solicita un token nuevo a Zoom; retorna (token, expires_in)"""
         auth_string = f"{ZOOM_API_KEY}:{ZOOM_API_SECRET}"
-        auth_bytes = auth_string.encode('ascii')
-        auth_base64 = base64.b64encode(auth_bytes).decode('ascii')
-        
+        auth_base64 = base64.b64encode(auth_string.encode('ascii')).decode('ascii')
         token_headers = {
             "Authorization": f"Basic {auth_base64}",
             "Content-Type": "application/x-www-form-urlencoded"
         }
+        token_data = {
+            "grant_type": "account_credentials",
+            "account_id": ZOOM_ACCOUNT_ID
+        }
+        start = time.perf_counter()
+        token_response = requests.post(self.TOKEN_URL, data=token_data, headers=token_headers, timeout=ZOOM_TIMEOUT)
+        metrics.observe("zoom_token_refresh_ms", (time.perf_counter() - start) * 1000)
+        metrics.incr("zoom_token_refreshes")
+        if token_response.status_code != 200:
+            metrics.incr("zoom_token_refresh_errors")
+            return None, 0
+        body = token_response.json()
+        return body['access_token'], body.get('expires_in', 3600)
+
+    def _refresh(self, stale_token):
+        """Renueva el token si nadie lo hizo ya (single-flight)"""
+        with self._refresh_lock:
+            if self._token is not None and self._token != stale_token and time.time() < self._expires_at:
+                return self._token
+            token, expires_in = self._fetch()
+            if token:
+                self._token = token
+                self._expires_at = time.time() + expires_in
+            return token
+
+    def _refresh_in_background(self, current):
+        if self._refreshing:
+            return
+        self._refreshing = True
+
+        def run():
+            try:
+                self._refresh(current)
+            except Exception as e:
+                print(f"Error renovando token de Zoom: {e}")
+            finally:
+                self._refreshing = False
+
+        threading.Thread(target=run, name="zoom-token-refresh", daemon=True).start()
+
+    def get_token(self):
+        """Retorna un token válido, renovándolo si hace falta"""
+        token, expires_at = self._token, self._expires_at
+        now = time.time()
+        if token and now < expires_at:
+            if now >= expires_at - self.refresh_margin:
+                self._refresh_in_background(token)
+            metrics.incr("zoom_token_cache_hits")
+            return token
+        return self._refresh(token)
+
+    def invalidate(self, token):
+        """Descarta el token si Zoom lo rechazó (401)"""
+        with self._refresh_lock:
+            if self._token == token:
+                self._token = None
+                self._expires_at = 0
+
+zoom_tokens = ZoomTokenManager()
+
+@protected_by("zoom", fallback=None)
+def create_zoom_meeting(topic, duration=60, start_time=None):
+    """Crea una reunión en Zoom"""
+    try:
+        access_token = zoom_tokens.get_token()
         
-        token_response = requests.post(token_url, data=token_data, headers=token_headers)
-        
-        if token_response.status_code != 200:
+        if not access_token:
             return None
         
-        access_token = token_response.json()['access_token']
-        
         url = "https://api.zoom.us/v2/users/me/meetings"
         
-        headers = {
-            "Authorization": f"Bearer {access_token}",
-            "Content-Type": "application/json"
-        }
-        
         if not start_time:
             start_time = (datetime.now() + timedelta(minutes=5)).strftime('%Y-%m-%dT%H:%M:%S')
         
@@ -309,7 +1860,19 @@ def create_zoom_meeting(topic, duration=60, start_time=None):
             }
         }
         
-        response = requests.post(url, headers=headers, json=meeting_data)
+        for attempt in range(2):
+            headers = {
+                "Authorization": f"Bearer {access_token}",
+                "Content-Type": "application/json"
+            }
+            response = requests.post(url, headers=headers, json=meeting_data, timeout=ZOOM_TIMEOUT)
+            if response.status_code != 401 or attempt == 1:
+                break
+            # Token revocado o vencido antes de tiempo: se renueva y se reintenta una vez
+            zoom_tokens.invalidate(access_token)
+            access_token = zoom_tokens.get_token()
+            if not access_token:
+                return None
         
         if response.status_code == 201:
             meeting_info = response.json()
@@ -330,22 +1893,60 @@ def create_zoom_meeting(topic, duration=60, start_time=None):
 # FUNCIONES DE GOOGLE MEET API
 # ============================================================================
 
+_google_calendar_base = None
+_google_calendar_lock = threading.Lock()
+_google_calendar_local = threading.local()
+
+def _get_google_calendar_base():
+    """Credenciales y documento de discovery, cargados una sola vez por worker"""
+    global _google_calendar_base
+    if _google_calendar_base is None:
+        with _google_calendar_lock:
+            if _google_calendar_base is None:
+                from google.oauth2 import service_account
+                from googleapiclient.discovery_cache import get_static_doc
+
+                credentials = service_account.Credentials.from_service_account_file(
+                    GOOGLE_CREDENTIALS_FILE,
+                    scopes=['https://www.googleapis.com/auth/calendar']
+                )
+                # Copia estática incluida en google-api-python-client: sin descarga en runtime
+                discovery_doc = get_static_doc('calendar', 'v3')
+                _google_calendar_base = (credentials, discovery_doc)
+    return _google_calendar_base
+
 def get_google_calendar_service():
-    """Crea y retorna el servicio de Google Calendar"""
+    """Retorna el servicio de Google Calendar del hilo actual.
+
+    httplib2 no es thread-safe, así que cada hilo construye (una vez) su
+    propio servicio sobre las credenciales compartidas.
+    """
+    service = getattr(_google_calendar_local, 'service', None)
+    if service is not None and _google_calendar_local.pid == os.getpid():
+        return service
     try:
-        credentials = service_account.Credentials.from_service_account_file(
-            GOOGLE_CREDENTIALS_FILE,
-            scopes=['https://www.googleapis.com/auth/calendar']
+        import httplib2
+        import google_auth_httplib2
+        from googleapiclient.discovery import build_from_document
+
+        credentials, discovery_doc = _get_google_calendar_base()
+        http = google_auth_httplib2.AuthorizedHttp(
+            credentials, http=httplib2.Http(timeout=GOOGLE_API_TIMEOUT)
         )
-        
-        service = build('calendar', 'v3', credentials=credentials)
+        service = build_from_document(discovery_doc, http=http)
+        _google_calendar_local.service = service
+        _google_calendar_local.pid = os.getpid()
+        metrics.incr("google_calendar_service_builds")
         return service
     except Exception as e:
         print(f"Error obteniendo servicio Google Calendar: {e}")
         return None
 
+@protected_by("google_calendar", fallback=None)
 def create_google_meet_meeting(summary, duration=60, start_time=None, attendee_email=None):
     """Crea una reunión de Google Meet"""
+    from googleapiclient.errors import HttpError
+    
     try:
         service = get_google_calendar_service()
         
@@ -370,7 +1971,8 @@ def create_google_meet_meeting(summary, duration=60, start_time=None, attendee_e
             },
             'conferenceData': {
                 'createRequest': {
-                    'requestId': f"meet-{int(time.time())}",
+                    # Único por evento: Google ignora un createRequest con id repetido
+                    'requestId': f"meet-{uuid.uuid4().hex}",
                     'conferenceSolutionKey': {
                         'type': 'hangoutsMeet'
                     }
@@ -404,6 +2006,14 @@ def create_google_meet_meeting(summary, duration=60, start_time=None, attendee_e
                     meet_link = entry.get('uri')
                     break
         
+        if not meet_link:
+            print(f"Evento {event['id']} creado sin enlace de Meet, se elimina")
+            try:
+                service.events().delete(calendarId=GOOGLE_CALENDAR_ID, eventId=event['id']).execute()
+            except Exception as e:
+                print(f"Error eliminando evento sin enlace: {e}")
+            return None
+        
         return {
             "platform": "google_meet",
             "meet_link": meet_link,
@@ -422,10 +2032,6 @@ def create_google_meet_meeting(summary, duration=60, start_time=None, attendee_e
 def save_video_call_info(patient_id, platform, meeting_url, meeting_id):
     """Guarda la información de la videollamada en la base de datos"""
     try:
-        headers = {
-            "Authorization": f"Bearer {API_KEY}",
-            "Content-Type": "application/json"
-        }
         data = {
             "patient_id": patient_id,
             "platform": platform,
@@ -434,38 +2040,538 @@ def save_video_call_info(patient_id, platform, meeting_url, meeting_id):
             "created_at": datetime.now().isoformat(),
             "status": "scheduled"
         }
-        response = requests.post(
-            f"{API_BASE_URL}/videollamadas",
-            headers=headers,
-            json=data,
-            timeout=10
-        )
-        return response.json()
+        return submit_patient_write("video_call", "/videollamadas", data)
     except Exception as e:
         print(f"Error guardando videollamada: {e}")
         return None
 
+# ============================================================================
+# SALAS PRECREADAS (WARM POOL)
+# ============================================================================
+
+def delete_zoom_meeting(meeting_id):
+    """Elimina una reunión de Zoom que no llegó a usarse"""
+    access_token = zoom_tokens.get_token()
+    if access_token:
+        requests.delete(
+            f"https://api.zoom.us/v2/meetings/{meeting_id}",
+            headers={"Authorization": f"Bearer {access_token}"},
+            timeout=ZOOM_TIMEOUT
+        )
+
+def delete_google_meet_event(event_id):
+    """Elimina un evento de Google Meet que no llegó a usarse"""
+    service = get_google_calendar_service()
+    if service:
+        service.events().delete(calendarId=GOOGLE_CALENDAR_ID, eventId=event_id).execute()
+
+class MeetingPool:
+    """Salas de videollamada creadas de antemano para entregarlas al instante.
+
+    Mantiene hasta `size` salas sin usar y solo crea nuevas al llenarse por
+    primera vez o después de entregar una, para no gastar la cuota diaria de
+    creación del proveedor sin tráfico. Las salas que superan `ttl` segundos
+    sin usarse se eliminan del proveedor; `start()` agrega un mantenimiento
+    periódico que las elimina sin reponerlas y limpia las que queden al
+    terminar el proceso. Al entregarse, la sala toma la hora actual como
+    hora de inicio.
+    """
+
+    def __init__(self, platform, factory, discard, size=MEETING_POOL_SIZE, ttl=MEETING_POOL_TTL):
+        self.platform = platform
+        self.factory = factory
+        self.discard = discard
+        self.size = size
+        self.ttl = ttl
+        self.maintenance_interval = min(600.0, max(1.0, ttl / 4))
+        self._rooms = deque()
+        self._lock = threading.Lock()
+        self._refilling = False
+        self._closed = False
+        self._maintenance_pid = None
+        metrics.register_gauge(f"meeting_pool_{platform}", lambda: {"available": len(self._rooms)})
+
+    def take(self):
+        """Entrega una sala lista o None si el pool está vacío o desactivado"""
+        if self.size <= 0:
+            return None
+        expired = []
+        room = None
+        with self._lock:
+            now = time.time()
+            while self._rooms:
+                created_at, candidate = self._rooms.popleft()
+                if now - created_at < self.ttl:
+                    room = candidate
+                    break
+                expired.append(candidate)
+        metrics.incr(f"meeting_pool_{self.platform}_{'hits' if room else 'misses'}")
+        self._discard_all(expired)
+        self.refill()
+        if room:
+            # La sala se creó con antelación: se entrega como si empezara ahora
+            room = dict(room, start_time=datetime.now().astimezone().isoformat(timespec='seconds'))
+        return room
+
+    def offer(self, room):
+        """Devuelve al pool una sala creada pero no entregada"""
+        with self._lock:
+            if len(self._rooms) < self.size:
+                self._rooms.append((time.time(), room))
+                return
+        self._discard_all([room])
+
+    def refill(self):
+        """Repone el pool en segundo plano (un solo hilo a la vez)"""
+        with self._lock:
+            if self._refilling or self._closed or self.size <= 0:
+                return
+            self._refilling = True
+        threading.Thread(target=self._refill, name=f"meeting-pool-{self.platform}", daemon=True).start()
+
+    def _refill(self):
+        try:
+            while True:
+                self.expire()
+                with self._lock:
+                    missing = self.size - len(self._rooms)
+                if missing <= 0:
+                    return
+                room = self.factory()
+                if not room:
+                    return
+                with self._lock:
+                    if not self._closed:
+                        self._rooms.append((time.time(), room))
+                        continue
+                self._discard_all([room])
+                return
+        except Exception as e:
+            print(f"Error reponiendo salas de {self.platform}: {e}")
+        finally:
+            self._refilling = False
+
+    def expire(self):
+        """Elimina del proveedor las salas vencidas, sin reponerlas"""
+        with self._lock:
+            limit = time.time() - self.ttl
+            expired = [room for created_at, room in self._rooms if created_at <= limit]
+            self._rooms = deque(item for item in self._rooms if item[0] > limit)
+        self._discard_all(expired)
+
+    def start(self):
+        """Llena el pool y elimina las salas vencidas en un hilo propio del proceso"""
+        if self.size <= 0:
+            return
+        with self._lock:
+            if self._maintenance_pid == os.getpid():
+                return
+            self._maintenance_pid = os.getpid()
+            self._closed = False
+        atexit.register(self.close)
+
+        self.refill()
+
+        def loop():
+            while not self._closed:
+                time.sleep(self.maintenance_interval)
+                self.expire()
+
+        threading.Thread(target=loop, name=f"meeting-pool-{self.platform}-upkeep", daemon=True).start()
+
+    def close(self):
+        """Elimina del proveedor las salas sin usar (al terminar el worker)"""
+        with self._lock:
+            self._closed = True
+            rooms = [room for _, room in self._rooms]
+            self._rooms.clear()
+        self._discard_all(rooms)
+
+    def _discard_all(self, rooms):
+        for room in rooms:
+            metrics.incr(f"meeting_pool_{self.platform}_expired")
+            try:
+                self.discard(room)
+            except Exception as e:
+                print(f"Error eliminando sala de {self.platform}: {e}")
+
+zoom_room_pool = MeetingPool(
+    "zoom",
+    lambda: create_zoom_meeting(topic="Consulta Ortopedia", duration=30),
+    lambda room: delete_zoom_meeting(room['meeting_id'])
+)
+meet_room_pool = MeetingPool(
+    "google_meet",
+    lambda: create_google_meet_meeting(summary="Consulta Ortopedia", duration=30),
+    lambda room: delete_google_meet_event(room['event_id'])
+)
+
 # ============================================================================
 # GESTIÓN DE SESIONES
 # ============================================================================
 
+class SessionState(str, Enum):
+    """Estados de la conversación"""
+    INITIAL = "initial"
+    AWAITING_CEDULA = "awaiting_cedula"
+    MAIN_MENU = "main_menu"
+    CONSULTAS_MENU = "consultas_menu"
+    SELECTING_VIDEO_PLATFORM = "selecting_video_platform"
+    DOCTOR_CHAT = "doctor_chat"
+
+class Session:
+    """Sesión compacta de un usuario.
+
+    El estado es un miembro compartido de SessionState y el historial es un
+    buffer circular de capacidad fija que solo se reserva con el primer turno.
+    Opcionalmente, los turnos fuera de la ventana reciente se guardan
+    comprimidos con zlib.
+    """
+
+    __slots__ = ("_state", "data", "_history", "_head")
+
+    HISTORY_SIZE = SESSION_HISTORY_SIZE
+    HOT_TURNS = SESSION_HISTORY_HOT_TURNS
+    COMPRESS_HISTORY = SESSION_HISTORY_COMPRESS
+    COMPRESS_MIN_CHARS = 200
+
+    def __init__(self, state=SessionState.INITIAL, data=None):
+        self.state = state
+        self.data = data if data is not None else {}
+        self._history = None
+        self._head = 0
+
+    @property
+    def state(self):
+        return self._state
+
+    @state.setter
+    def state(self, value):
+        self._state = SessionState(value)
+
+    def add_turn(self, role, content, tokens=None):
+        """Agrega un turno; al llenarse sobrescribe el más antiguo.
+
+        El conteo de tokens se calcula una sola vez y se guarda con el turno.
+        """
+        if tokens is None:
+            tokens = count_tokens(content)
+        if self._history is None:
+            self._history = []
+        if len(self._history) < self.HISTORY_SIZE:
+            self._history.append((role, content, tokens))
+        else:
+            self._history[self._head] = (role, content, tokens)
+            self._head = (self._head + 1) % self.HISTORY_SIZE
+        if self.COMPRESS_HISTORY and len(self._history) > self.HOT_TURNS:
+            self._compress_turn(len(self._history) - self.HOT_TURNS - 1)
+
+    def _compress_turn(self, index):
+        position = (self._head + index) % len(self._history)
+        role, content, tokens = self._history[position]
+        if isinstance(content, str) and len(content) >= self.COMPRESS_MIN_CHARS:
+            packed = zlib.compress(content.encode('utf-8'))
+            if len(packed) < len(content):
+                self._history[position] = (role, packed, tokens)
+
+    @staticmethod
+    def _text(content):
+        return content if isinstance(content, str) else zlib.decompress(content).decode('utf-8')
+
+    def _ordered(self):
+        if not self._history:
+            return []
+        return self._history[self._head:] + self._history[:self._head]
+
+    @property
+    def conversation_history(self):
+        """Turnos en orden cronológico como dicts {role, content}"""
+        return [{"role": role, "content": self._text(content)} for role, content, _ in self._ordered()]
+
+    def recent_turns(self, max_tokens):
+        """Turnos más recientes que suman como máximo `max_tokens`.
+
+        Retorna (turnos en orden cronológico, cantidad de turnos antiguos que
+        quedaron fuera). Solo se descomprimen los turnos seleccionados.
+        """
+        turns = self._ordered()
+        selected, used = [], 0
+        for role, content, tokens in reversed(turns):
+            if used + tokens > max_tokens:
+                break
+            used += tokens
+            selected.append({"role": role, "content": self._text(content)})
+        selected.reverse()
+        return selected, len(turns) - len(selected)
+
+    def drop_oldest(self, count):
+        """Elimina los `count` turnos más antiguos"""
+        turns = self._ordered()[count:]
+        self._history = turns or None
+        self._head = 0
+
+    def to_dict(self):
+        """Representación serializable en JSON"""
+        return {
+            "state": self._state.value,
+            "data": self.data,
+            "conversation_history": [
+                {"role": role, "content": self._text(content), "tokens": tokens}
+                for role, content, tokens in self._ordered()
+            ]
+        }
+
+    @classmethod
+    def from_dict(cls, raw):
+        """Reconstruye una sesión desde to_dict()"""
+        session = cls(raw.get("state", SessionState.INITIAL), raw.get("data"))
+        for turn in raw.get("conversation_history", []):
+            session.add_turn(turn["role"], turn["content"], turn.get("tokens"))
+        return session
+
+def new_session():
+    """Estructura de una sesión nueva"""
+    return Session()
+
+def _deep_sizeof(obj):
+    """Tamaño aproximado en bytes de un objeto y su contenido"""
+    if isinstance(obj, Enum):
+        return 0  # los miembros son compartidos entre sesiones
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(_deep_sizeof(k) + _deep_sizeof(v) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set)):
+        size += sum(_deep_sizeof(item) for item in obj)
+    elif hasattr(obj, '__slots__'):
+        size += sum(_deep_sizeof(getattr(obj, name, None)) for name in obj.__slots__)
+    return size
+
+class SessionStore:
+    """Interfaz de almacenamiento de sesiones con expiración por inactividad"""
+
+    def get(self, phone_number):
+        """Retorna la sesión o None si no existe o expiró"""
+        raise NotImplementedError
+
+    def save(self, phone_number, session):
+        """Guarda la sesión y renueva su tiempo de vida"""
+        raise NotImplementedError
+
+    def update(self, phone_number, func):
+        """Lectura-modificación-escritura atómica; crea la sesión si no existe"""
+        raise NotImplementedError
+
+    def delete(self, phone_number):
+        """Elimina la sesión"""
+        raise NotImplementedError
+
+    def stats(self):
+        """Tamaño y uso de memoria del almacén"""
+        raise NotImplementedError
+
+class InMemorySessionStore(SessionStore):
+    """Sesiones en memoria del proceso, ordenadas por último acceso (LRU)"""
+
+    STATS_SAMPLE_SIZE = 100
+
+    def __init__(self, ttl=SESSION_TTL, max_size=SESSION_MAX_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._sessions = OrderedDict()
+        self._lock = threading.RLock()
+
+    def _evict_expired(self, now):
+        # El orden es por último acceso: las expiradas están al principio
+        while self._sessions:
+            phone_number, (last_access, _) = next(iter(self._sessions.items()))
+            if now - last_access < self.ttl:
+                break
+            del self._sessions[phone_number]
+            metrics.incr("sessions_expired")
+
+    def get(self, phone_number):
+        now = time.time()
+        with self._lock:
+            self._evict_expired(now)
+            item = self._sessions.get(phone_number)
+            if item is None:
+                return None
+            self._sessions[phone_number] = (now, item[1])
+            self._sessions.move_to_end(phone_number)
+            return item[1]
+
+    def save(self, phone_number, session):
+        now = time.time()
+        with self._lock:
+            self._sessions[phone_number] = (now, session)
+            self._sessions.move_to_end(phone_number)
+            while len(self._sessions) > self.max_size:
+                self._sessions.popitem(last=False)
+                metrics.incr("sessions_evicted")
+
+    def update(self, phone_number, func):
+        with self._lock:
+            session = self.get(phone_number)
+            if session is None:
+                session = new_session()
+            func(session)
+            self.save(phone_number, session)
+            return session
+
+    def delete(self, phone_number):
+        with self._lock:
+            self._sessions.pop(phone_number, None)
+
+    def stats(self):
+        # Medir todas las sesiones bloquearía el almacén; se estima con una
+        # muestra, tomando el lock solo para copiar referencias y por sesión medida
+        with self._lock:
+            items = list(self._sessions.items())
+            container = sys.getsizeof(self._sessions)
+        sample = random.sample(items, min(len(items), self.STATS_SAMPLE_SIZE))
+        sampled = 0
+        for item in sample:
+            with self._lock:
+                sampled += _deep_sizeof(item)
+        per_session = sampled / len(sample) if sample else 0
+        return {
+            "backend": "memory",
+            "size": len(items),
+            "max_size": self.max_size,
+            "memory_bytes": int(container + per_session * len(items))
+        }
+
+class SQLiteSessionStore(SessionStore):
+    """Sesiones serializadas en SQLite (modo WAL).
+
+    El archivo puede compartirse entre todos los workers de gunicorn del host,
+    así los mensajes consecutivos de un usuario ven el mismo estado aunque
+    lleguen a procesos distintos.
+    """
+
+    PRUNE_EVERY = 500
+
+    def __init__(self, path=SESSION_DB_PATH, ttl=SESSION_TTL, max_size=SESSION_MAX_SIZE):
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        self._writes = 0
+        conn = get_sqlite_connection(path)
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions "
+            "(phone TEXT PRIMARY KEY, payload TEXT NOT NULL, last_access REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_last_access ON sessions (last_access)")
+
+    def get(self, phone_number):
+        conn = get_sqlite_connection(self.path)
+        now = time.time()
+        row = conn.execute(
+            "SELECT payload, last_access FROM sessions WHERE phone = ?", (phone_number,)
+        ).fetchone()
+        if row is None:
+            return None
+        if now - row[1] >= self.ttl:
+            self.delete(phone_number)
+            metrics.incr("sessions_expired")
+            return None
+        conn.execute("UPDATE sessions SET last_access = ? WHERE phone = ?", (now, phone_number))
+        return Session.from_dict(json.loads(row[0]))
+
+    def save(self, phone_number, session):
+        conn = get_sqlite_connection(self.path)
+        conn.execute(
+            "INSERT OR REPLACE INTO sessions (phone, payload, last_access) VALUES (?, ?, ?)",
+            (phone_number, json.dumps(session.to_dict()), time.time())
+        )
+        self._count_write()
+
+    def update(self, phone_number, func):
+        conn = get_sqlite_connection(self.path)
+        now = time.time()
+        # BEGIN IMMEDIATE toma el lock de escritura antes de leer
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT payload, last_access FROM sessions WHERE phone = ?", (phone_number,)
+            ).fetchone()
+            if row is not None and now - row[1] < self.ttl:
+                session = Session.from_dict(json.loads(row[0]))
+            else:
+                session = new_session()
+            func(session)
+            conn.execute(
+                "INSERT OR REPLACE INTO sessions (phone, payload, last_access) VALUES (?, ?, ?)",
+                (phone_number, json.dumps(session.to_dict()), now)
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        self._count_write()
+        return session
+
+    def _count_write(self):
+        self._writes += 1
+        if self._writes % self.PRUNE_EVERY == 0:
+            self.prune()
+
+    def prune(self):
+        """Elimina sesiones expiradas y las más antiguas por encima del máximo"""
+        conn = get_sqlite_connection(self.path)
+        conn.execute("DELETE FROM sessions WHERE last_access < ?", (time.time() - self.ttl,))
+        excess = conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0] - self.max_size
+        if excess > 0:
+            conn.execute(
+                "DELETE FROM sessions WHERE phone IN "
+                "(SELECT phone FROM sessions ORDER BY last_access LIMIT ?)",
+                (excess,)
+            )
+            metrics.incr("sessions_evicted", excess)
+
+    def delete(self, phone_number):
+        get_sqlite_connection(self.path).execute(
+            "DELETE FROM sessions WHERE phone = ?", (phone_number,)
+        )
+
+    def stats(self):
+        conn = get_sqlite_connection(self.path)
+        page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+        page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+        return {
+            "backend": "sqlite",
+            "size": conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0],
+            "max_size": self.max_size,
+            "memory_bytes": page_count * page_size
+        }
+
+def create_session_store(backend=SESSION_BACKEND):
+    """Crea el almacén de sesiones configurado"""
+    if backend == 'sqlite':
+        return SQLiteSessionStore()
+    return InMemorySessionStore()
+
+session_store = create_session_store()
+metrics.register_gauge("sessions", session_store.stats)
+
+if isinstance(session_store, InMemorySessionStore) and int(os.getenv('WEB_CONCURRENCY', '1')) > 1:
+    print("Advertencia: sesiones en memoria con varios workers; usa SESSION_BACKEND=sqlite")
+
 def get_user_session(phone_number):
     """Obtiene o crea una sesión de usuario"""
-    if phone_number not in user_sessions:
-        user_sessions[phone_number] = {
-            "state": "initial",
-            "data": {},
-            "conversation_history": []
-        }
-    return user_sessions[phone_number]
+    session = session_store.get(phone_number)
+    if session is None:
+        session = session_store.update(phone_number, lambda s: None)
+    return session
 
 def update_user_session(phone_number, state=None, data=None):
     """Actualiza la sesión del usuario"""
-    session = get_user_session(phone_number)
-    if state:
-        session["state"] = state
-    if data:
-        session["data"].update(data)
+    def apply(session):
+        if state:
+            session.state = state
+        if data:
+            session.data.update(data)
+    return session_store.update(phone_number, apply)
 
 # ============================================================================
 # MENÚ Y NAVEGACIÓN
@@ -516,6 +2622,19 @@ def handle_medical_consultation(phone_number):
     )
     update_user_session(phone_number, state="consultas_menu")
 
+def answer_doctor_question(phone_number, question):
+    """Responde en el chat con el doctor: primero la FAQ local, luego la IA"""
+    history = conversation_context(get_user_session(phone_number))
+    answer = faq_retriever.answer(question)
+    if answer is None and AI_STREAMING:
+        answer = stream_ai_response(phone_number, question, history)
+    else:
+        if answer is None:
+            answer = get_ai_response(question, history=history)
+        send_whatsapp_message(phone_number, answer)
+    if answer != AI_FALLBACK_MESSAGE:
+        record_conversation_turns(phone_number, question, answer)
+
 def initiate_video_call(phone_number):
     """Inicia una videollamada con opciones de Zoom o Google Meet"""
     buttons = [
@@ -532,17 +2651,59 @@ def initiate_video_call(phone_number):
 
 def handle_video_call_zoom(phone_number):
     """Maneja la creación de videollamada por Zoom"""
-    session = get_user_session(phone_number)
-    patient_data = session["data"]
-    patient_name = patient_data.get("nombre", "Paciente")
-    
-    send_whatsapp_message(phone_number, "📹 Creando tu sala de Zoom...")
-    
-    meeting_topic = f"Consulta Ortopedia - {patient_name}"
-    meeting = create_zoom_meeting(topic=meeting_topic, duration=30)
-    
-    if meeting:
-        message = (
+    if resend_active_video_call(phone_number, "zoom"):
+        return
+    start_video_call(phone_number, "zoom", "📹 Creando tu sala de Zoom...")
+
+def handle_video_call_meet(phone_number):
+    """Maneja la creación de videollamada por Google Meet"""
+    if resend_active_video_call(phone_number, "google_meet"):
+        return
+    start_video_call(phone_number, "google_meet", "🎥 Creando tu sala de Google Meet...")
+
+# ============================================================================
+# VIDEOLLAMADAS EN SEGUNDO PLANO
+# ============================================================================
+
+# Orquestación (espera, alternativa, envío) y llamadas a proveedores en pools
+# separados, para que un job nunca espere a un hilo de su propio pool
+video_call_jobs = ThreadPoolExecutor(max_workers=VIDEO_CALL_WORKERS, thread_name_prefix="video-job")
+video_call_providers = ThreadPoolExecutor(max_workers=VIDEO_CALL_WORKERS * 2, thread_name_prefix="video-provider")
+
+# Las salas en creación se marcan en la sesión del paciente (compartida entre
+# workers) para no crear otra si insiste; una marca huérfana de un worker
+# caído caduca sola
+VIDEO_CALL_PENDING_TTL = max(120, 4 * VIDEO_CALL_TIMEOUT)
+
+VIDEO_CALL_PLATFORMS = {
+    "zoom": {
+        "name": "Zoom",
+        "pool": lambda: zoom_room_pool,
+        "create": lambda patient_name: create_zoom_meeting(
+            topic=f"Consulta Ortopedia - {patient_name}", duration=VIDEO_CALL_PLATFORMS["zoom"]["duration"]
+        ),
+        "url_key": "join_url",
+        "id_key": "meeting_id",
+        "duration": 30,
+        "fallback": "google_meet"
+    },
+    "google_meet": {
+        "name": "Google Meet",
+        "pool": lambda: meet_room_pool,
+        "create": lambda patient_name: create_google_meet_meeting(
+            summary=f"Consulta Ortopedia - {patient_name}", duration=VIDEO_CALL_PLATFORMS["google_meet"]["duration"]
+        ),
+        "url_key": "meet_link",
+        "id_key": "event_id",
+        "duration": 30,
+        "fallback": "zoom"
+    }
+}
+
+def format_video_call_message(meeting):
+    """Mensaje con los datos de la videollamada creada"""
+    if meeting["platform"] == "zoom":
+        return (
             f"✅ *Videollamada Zoom Creada*\n\n"
             f"📅 Hora: {meeting['start_time']}\n"
             f"🔢 ID de reunión: {meeting['meeting_id']}\n"
@@ -550,51 +2711,414 @@ def handle_video_call_zoom(phone_number):
             f"🔗 Enlace directo:\n{meeting['join_url']}\n\n"
             f"💡 Puedes unirte 5 minutos antes de la hora programada."
         )
-        send_whatsapp_message(phone_number, message)
-        
-        save_video_call_info(
-            patient_data.get("patient_id"),
-            "zoom",
-            meeting['join_url'],
-            meeting['meeting_id']
+    return (
+        f"✅ *Videollamada Google Meet Creada*\n\n"
+        f"📅 Hora: {meeting['start_time']}\n\n"
+        f"🔗 Enlace de la reunión:\n{meeting['meet_link']}\n\n"
+        f"💡 Puedes unirte en cualquier momento usando el enlace."
+    )
+
+def _meeting_window_end(meeting, duration):
+    """Momento (epoch) en que termina la reunión según su hora de inicio y duración"""
+    try:
+        start = datetime.fromisoformat(meeting["start_time"])
+        start_ts = start.timestamp()
+    except (KeyError, TypeError, ValueError):
+        start_ts = time.time()
+    return start_ts + duration * 60
+
+def remember_active_meeting(phone_number, meeting):
+    """Guarda la reunión en la sesión del paciente hasta que termine"""
+    expires_at = _meeting_window_end(meeting, VIDEO_CALL_PLATFORMS[meeting["platform"]]["duration"])
+
+    def apply(session):
+        now = time.time()
+        active = {
+            platform: item
+            for platform, item in session.data.get("active_meetings", {}).items()
+            if item["expires_at"] > now
+        }
+        active[meeting["platform"]] = {"meeting": meeting, "expires_at": expires_at}
+        session.data["active_meetings"] = active
+
+    session_store.update(phone_number, apply)
+
+def find_active_meeting(phone_number, platform):
+    """Reunión vigente del paciente en la plataforma, o None"""
+    item = get_user_session(phone_number).data.get("active_meetings", {}).get(platform)
+    if item and item["expires_at"] > time.time():
+        return item["meeting"]
+    return None
+
+def resend_active_video_call(phone_number, platform):
+    """Si el paciente ya tiene una reunión vigente, reenvía su enlace sin crear otra"""
+    meeting = find_active_meeting(phone_number, platform)
+    if not meeting:
+        return False
+    metrics.incr("video_call_reused")
+    send_whatsapp_message(
+        phone_number,
+        "ℹ️ Ya tienes una videollamada programada:\n\n" + format_video_call_message(meeting)
+    )
+    return True
+
+def claim_video_call(phone_number, platform):
+    """Marca la creación en curso; False si ya había una vigente"""
+    claimed = []
+
+    def apply(session):
+        now = time.time()
+        pending = {
+            name: started
+            for name, started in session.data.get("video_calls_pending", {}).items()
+            if now - started < VIDEO_CALL_PENDING_TTL
+        }
+        if platform not in pending:
+            pending[platform] = now
+            claimed.append(True)
+        session.data["video_calls_pending"] = pending
+
+    session_store.update(phone_number, apply)
+    return bool(claimed)
+
+def release_video_call(phone_number, platform):
+    """Quita la marca de creación en curso"""
+    session_store.update(
+        phone_number,
+        lambda session: session.data.get("video_calls_pending", {}).pop(platform, None)
+    )
+
+def start_video_call(phone_number, platform, creating_message=None):
+    """Lanza la creación de la videollamada; el enlace se envía al terminar.
+
+    Si ya hay una creación en curso para el paciente y la plataforma, no se
+    crea otra sala: el enlace de la primera llegará en cuanto esté lista.
+    """
+    if not claim_video_call(phone_number, platform):
+        metrics.incr("video_call_in_flight_repeats")
+        send_whatsapp_message(
+            phone_number,
+            f"⏳ Ya estamos creando tu sala de {VIDEO_CALL_PLATFORMS[platform]['name']}, "
+            f"te enviaremos el enlace en cuanto esté lista."
         )
-    else:
+        return
+    if creating_message:
+        send_whatsapp_message(phone_number, creating_message)
+    patient_data = dict(get_user_session(phone_number).data)
+    patient_data.pop("active_meetings", None)
+    patient_data.pop("video_calls_pending", None)
+    try:
+        if VIDEO_CALL_ASYNC:
+            video_call_jobs.submit(run_video_call_job, phone_number, platform, patient_data)
+        else:
+            run_video_call_job(phone_number, platform, patient_data)
+    except RuntimeError as e:
+        # El executor ya se cerró (apagado del worker)
+        print(f"Error lanzando videollamada: {e}")
+        release_video_call(phone_number, platform)
+
+def run_video_call_job(phone_number, platform, patient_data):
+    """Job de creación; libera la marca de creación en curso al terminar"""
+    try:
+        provision_video_call(phone_number, platform, patient_data)
+    except Exception as e:
+        print(f"Error en el job de videollamada ({platform}): {e}")
+        metrics.incr("video_call_job_errors")
         send_whatsapp_message(
             phone_number,
-            "❌ No pudimos crear la videollamada de Zoom. Contacta con soporte."
+            "❌ Ocurrió un error creando tu videollamada. Intenta de nuevo en unos minutos."
         )
+    finally:
+        try:
+            release_video_call(phone_number, platform)
+        except Exception as e:
+            # La marca caduca sola tras VIDEO_CALL_PENDING_TTL
+            print(f"Error liberando la marca de videollamada: {e}")
 
-def handle_video_call_meet(phone_number):
-    """Maneja la creación de videollamada por Google Meet"""
-    session = get_user_session(phone_number)
-    patient_data = session["data"]
+def _create_with_timeout(platform, patient_name):
+    """Crea la sala esperando como máximo VIDEO_CALL_TIMEOUT segundos"""
+    config = VIDEO_CALL_PLATFORMS[platform]
+    meeting = config["pool"]().take()
+    if meeting:
+        return meeting
+    future = video_call_providers.submit(config["create"], patient_name)
+    try:
+        return future.result(timeout=VIDEO_CALL_TIMEOUT)
+    except FutureTimeoutError:
+        metrics.incr(f"video_call_{platform}_timeouts")
+        print(f"Timeout creando videollamada de {config['name']} ({VIDEO_CALL_TIMEOUT}s)")
+        def recycle(late):
+            # Si la sala termina de crearse tarde, no se pierde: vuelve al pool o se elimina
+            if late.exception() is None and late.result():
+                config["pool"]().offer(late.result())
+
+        future.add_done_callback(recycle)
+        return None
+    except Exception as e:
+        metrics.incr(f"video_call_{platform}_errors")
+        print(f"Error creando videollamada de {config['name']}: {e}")
+        return None
+
+def provision_video_call(phone_number, platform, patient_data):
+    """Job: crea la sala (con alternativa en la otra plataforma) y envía el enlace"""
+    start = time.perf_counter()
     patient_name = patient_data.get("nombre", "Paciente")
+    config = VIDEO_CALL_PLATFORMS[platform]
     
-    send_whatsapp_message(phone_number, "🎥 Creando tu sala de Google Meet...")
-    
-    meeting_summary = f"Consulta Ortopedia - {patient_name}"
-    meeting = create_google_meet_meeting(summary=meeting_summary, duration=30)
-    
-    if meeting:
-        message = (
-            f"✅ *Videollamada Google Meet Creada*\n\n"
-            f"📅 Hora: {meeting['start_time']}\n\n"
-            f"🔗 Enlace de la reunión:\n{meeting['meet_link']}\n\n"
-            f"💡 Puedes unirte en cualquier momento usando el enlace."
-        )
-        send_whatsapp_message(phone_number, message)
-        
-        save_video_call_info(
-            patient_data.get("patient_id"),
-            "google_meet",
-            meeting['meet_link'],
-            meeting['event_id']
+    meeting = _create_with_timeout(platform, patient_name)
+    if not meeting:
+        fallback = VIDEO_CALL_PLATFORMS[config["fallback"]]
+        send_whatsapp_message(
+            phone_number,
+            f"⚠️ {config['name']} no está respondiendo, creando tu sala en {fallback['name']}..."
         )
-    else:
+        meeting = _create_with_timeout(config["fallback"], patient_name)
+    
+    if not meeting:
         send_whatsapp_message(
             phone_number,
-            "❌ No pudimos crear la videollamada de Google Meet. Contacta con soporte."
+            f"❌ No pudimos crear la videollamada de {config['name']}. Contacta con soporte."
         )
+        metrics.incr("video_call_failures")
+        return
+    
+    meeting_config = VIDEO_CALL_PLATFORMS[meeting["platform"]]
+    save = video_call_providers.submit(
+        save_video_call_info,
+        patient_data.get("patient_id"),
+        meeting["platform"],
+        meeting[meeting_config["url_key"]],
+        meeting[meeting_config["id_key"]]
+    )
+    send_whatsapp_message(phone_number, format_video_call_message(meeting))
+    metrics.observe("video_call_link_ms", (time.perf_counter() - start) * 1000)
+
+    # El paciente ya tiene su enlace: un fallo al registrar no debe afectarlo
+    try:
+        remember_active_meeting(phone_number, meeting)
+        save.result()
+    except Exception as e:
+        print(f"Error registrando videollamada de {meeting_config['name']}: {e}")
+        metrics.incr("video_call_bookkeeping_errors")
+
+# ============================================================================
+# DEDUPLICACIÓN DE MENSAJES
+# ============================================================================
+
+class MessageDeduplicator:
+    """Descarta mensajes ya recibidos, identificados por su `id` de WhatsApp.
+
+    Usa un LRU con TTL en memoria y, si se configura `db_path`, una tabla
+    SQLite compartida por todos los workers del host.
+    """
+
+    def __init__(self, ttl=DEDUP_TTL, max_size=DEDUP_MAX_SIZE, db_path=DEDUP_DB_PATH):
+        self.ttl = ttl
+        self.db_path = db_path
+        self._cache = TTLCache(maxsize=max_size, ttl=ttl)
+        self._lock = threading.Lock()
+        self._inserts = 0
+        if db_path:
+            get_sqlite_connection(db_path).execute(
+                "CREATE TABLE IF NOT EXISTS processed_messages "
+                "(id TEXT PRIMARY KEY, seen_at REAL NOT NULL)"
+            )
+
+    def is_duplicate(self, message_id):
+        """Registra el id y retorna True si ya se había visto"""
+        if not message_id:
+            return False
+        with self._lock:
+            if message_id in self._cache:
+                duplicate = True
+            else:
+                self._cache[message_id] = True
+                duplicate = self.db_path is not None and not self._claim_shared(message_id)
+        metrics.incr("dedup_hits" if duplicate else "dedup_misses")
+        return duplicate
+
+    def _claim_shared(self, message_id):
+        """Inserta el id en SQLite; retorna False si otro worker ya lo tenía"""
+        try:
+            conn = get_sqlite_connection(self.db_path)
+            now = time.time()
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO processed_messages (id, seen_at) VALUES (?, ?)",
+                (message_id, now)
+            )
+            if cursor.rowcount == 0:
+                row = conn.execute(
+                    "SELECT seen_at FROM processed_messages WHERE id = ?", (message_id,)
+                ).fetchone()
+                if row and now - row[0] < self.ttl:
+                    return False
+                conn.execute(
+                    "UPDATE processed_messages SET seen_at = ? WHERE id = ?", (now, message_id)
+                )
+            self._inserts += 1
+            if self._inserts % 1000 == 0:
+                conn.execute("DELETE FROM processed_messages WHERE seen_at < ?", (now - self.ttl,))
+            return True
+        except sqlite3.Error as e:
+            print(f"Error en almacenamiento de deduplicación: {e}")
+            return True
+
+    def forget(self, message_id):
+        """Olvida un id para que una reentrega posterior sí se procese"""
+        with self._lock:
+            self._cache.pop(message_id, None)
+            if self.db_path:
+                try:
+                    get_sqlite_connection(self.db_path).execute(
+                        "DELETE FROM processed_messages WHERE id = ?", (message_id,)
+                    )
+                except sqlite3.Error as e:
+                    print(f"Error en almacenamiento de deduplicación: {e}")
+
+message_deduplicator = MessageDeduplicator()
+
+# ============================================================================
+# BLOQUEOS POR USUARIO
+# ============================================================================
+
+class UserLockManager:
+    """Serializa el procesamiento por número de teléfono con locks en franjas.
+
+    Cada número se asigna a una de `stripes` franjas: los mensajes del mismo
+    usuario nunca se procesan a la vez y usuarios en franjas distintas avanzan
+    en paralelo. El tiempo de espera se registra en métricas.
+
+    Con `path`, cada franja es además un byte de ese archivo bloqueado con
+    fcntl.lockf, de modo que la exclusión se cumple entre workers de gunicorn
+    y no solo entre hilos del mismo proceso.
+    """
+
+    def __init__(self, stripes=USER_LOCK_STRIPES, path=USER_LOCK_PATH):
+        self.stripes = max(1, stripes)
+        self.path = path if path and fcntl is not None else None
+        self._locks = [threading.Lock() for _ in range(self.stripes)]
+        self._fd = None
+        self._fd_pid = None
+        self._fd_lock = threading.Lock()
+        if path and fcntl is None:
+            print("Advertencia: fcntl no disponible, USER_LOCK_PATH se ignora")
+
+    def _stripe_for(self, phone_number):
+        return zlib.crc32(phone_number.encode('utf-8')) % self.stripes
+
+    def _file(self):
+        # Los locks de fcntl son por proceso: tras un fork cada worker abre su descriptor
+        with self._fd_lock:
+            if self._fd_pid != os.getpid():
+                directory = os.path.dirname(self.path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+                self._fd_pid = os.getpid()
+            return self._fd
+
+    @contextmanager
+    def hold(self, phone_number):
+        """Adquiere el lock del usuario durante el bloque"""
+        stripe = self._stripe_for(phone_number)
+        lock = self._locks[stripe]
+        start = time.perf_counter()
+        contended = not lock.acquire(blocking=False)
+        if contended:
+            lock.acquire()
+        fd = None
+        try:
+            if self.path:
+                # El lock del hilo va primero: dentro del proceso lockf no excluye
+                fd = self._file()
+                try:
+                    fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, stripe, os.SEEK_SET)
+                except OSError:
+                    contended = True
+                    fcntl.lockf(fd, fcntl.LOCK_EX, 1, stripe, os.SEEK_SET)
+            if contended:
+                metrics.incr("user_lock_contended")
+                metrics.observe("user_lock_wait_ms", (time.perf_counter() - start) * 1000)
+            yield
+        finally:
+            if fd is not None:
+                fcntl.lockf(fd, fcntl.LOCK_UN, 1, stripe, os.SEEK_SET)
+            lock.release()
+
+user_locks = UserLockManager()
+
+if user_locks.path is None and int(os.getenv('WEB_CONCURRENCY', '1')) > 1:
+    print("Advertencia: locks por usuario solo dentro del proceso con varios workers; define USER_LOCK_PATH")
+
+# ============================================================================
+# PROCESAMIENTO EN SEGUNDO PLANO
+# ============================================================================
+
+class MessageDispatcher:
+    """Pool acotado de workers que procesa mensajes fuera del request del webhook.
+
+    Cada número de teléfono se asigna siempre al mismo worker (por hash), de
+    modo que los mensajes de un usuario se procesan en orden estricto mientras
+    que usuarios distintos avanzan en paralelo.
+    """
+
+    def __init__(self, workers=WEBHOOK_WORKERS, queue_size=WEBHOOK_QUEUE_SIZE):
+        self.workers = max(1, workers)
+        self.queue_size = queue_size
+        self._queues = []
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _ensure_started(self):
+        """Arranca los hilos de forma perezosa, una vez por proceso"""
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._lock:
+            if self._pid == pid:
+                return
+            self._queues = []
+            for i in range(self.workers):
+                q = queue.Queue(maxsize=self.queue_size)
+                worker = threading.Thread(
+                    target=self._run, args=(q,), name=f"webhook-worker-{i}", daemon=True
+                )
+                worker.start()
+                self._queues.append(q)
+            self._pid = pid
+
+    def _run(self, q):
+        while True:
+            func, args = q.get()
+            try:
+                func(*args)
+            except Exception as e:
+                print(f"Error procesando mensaje en segundo plano: {e}")
+            finally:
+                q.task_done()
+
+    def _queue_for(self, phone_number):
+        return self._queues[zlib.crc32(phone_number.encode('utf-8')) % self.workers]
+
+    def submit(self, phone_number, func, *args):
+        """Encola una tarea para el usuario; retorna False si la cola está llena"""
+        self._ensure_started()
+        try:
+            self._queue_for(phone_number).put_nowait((func, args))
+            return True
+        except queue.Full:
+            return False
+
+    def pending(self):
+        """Número de tareas pendientes en todas las colas"""
+        return sum(q.qsize() for q in self._queues)
+
+    def join(self):
+        """Espera a que se vacíen todas las colas"""
+        for q in list(self._queues):
+            q.join()
+
+message_dispatcher = MessageDispatcher()
 
 # ============================================================================
 # WEBHOOK
@@ -621,17 +3145,68 @@ def webhook():
     data = request.get_json()
     
     try:
-        entry = data['entry'][0]
-        changes = entry['changes'][0]
-        value = changes['value']
+        messages = extract_messages(data)
+        metrics.observe("webhook_messages_per_post", len(messages))
+        messages = [m for m in messages if not message_deduplicator.is_duplicate(m.get('id'))]
         
-        if 'messages' not in value:
+        if not messages:
             return jsonify({"status": "ok"}), 200
         
-        message = value['messages'][0]
-        phone_number = message['from']
-        message_type = message['type']
+        if WEBHOOK_ASYNC:
+            for i, message in enumerate(messages):
+                if not message_dispatcher.submit(message['from'], dispatch_message, message):
+                    for pending in messages[i:]:
+                        message_deduplicator.forget(pending.get('id'))
+                    # Meta reintentará la entrega más tarde
+                    return jsonify({"status": "busy"}), 503
+        else:
+            process_message_batch(messages)
+        
+        return jsonify({"status": "ok"}), 200
         
+    except Exception as e:
+        print(f"Error en webhook: {e}")
+        return jsonify({"status": "error"}), 500
+
+def extract_messages(data):
+    """Extrae todos los mensajes de todas las entradas y cambios del payload"""
+    messages = []
+    for entry in (data or {}).get('entry', []):
+        for change in entry.get('changes', []):
+            messages.extend(change.get('value', {}).get('messages', []))
+    return messages
+
+batch_executor = ThreadPoolExecutor(max_workers=WEBHOOK_BATCH_WORKERS, thread_name_prefix="webhook-batch")
+
+def process_message_batch(messages):
+    """Procesa un lote: usuarios distintos en paralelo, cada usuario en orden"""
+    by_phone = {}
+    for message in messages:
+        by_phone.setdefault(message['from'], []).append(message)
+    
+    if len(by_phone) == 1:
+        process_user_messages(messages)
+        return
+    
+    futures = [batch_executor.submit(process_user_messages, msgs) for msgs in by_phone.values()]
+    for future in futures:
+        future.result()
+
+def process_user_messages(messages):
+    """Procesa en orden los mensajes de un mismo usuario"""
+    for message in messages:
+        try:
+            dispatch_message(message)
+        except Exception as e:
+            print(f"Error procesando mensaje {message.get('id')}: {e}")
+
+def dispatch_message(message):
+    """Envía un mensaje entrante al procesador según su tipo"""
+    phone_number = message['from']
+    message_type = message['type']
+    
+    # Evita que dos mensajes del mismo usuario lean y escriban la sesión a la vez
+    with user_locks.hold(phone_number):
         if message_type == 'text':
             text = message['text']['body'].lower().strip()
             process_text_message(phone_number, text)
@@ -644,17 +3219,11 @@ def webhook():
             elif interactive['type'] == 'list_reply':
                 list_id = interactive['list_reply']['id']
                 process_list_response(phone_number, list_id)
-        
-        return jsonify({"status": "ok"}), 200
-        
-    except Exception as e:
-        print(f"Error en webhook: {e}")
-        return jsonify({"status": "error"}), 500
 
 def process_text_message(phone_number, text):
     """Procesa mensajes de texto"""
     session = get_user_session(phone_number)
-    state = session["state"]
+    state = session.state
     
     if text in ['menu', 'menú', 'inicio']:
         show_main_menu(phone_number)
@@ -669,6 +3238,9 @@ def process_text_message(phone_number, text):
         )
         update_user_session(phone_number, state="awaiting_cedula")
 
+    elif state == "doctor_chat":
+        answer_doctor_question(phone_number, text)
+
 def process_button_response(phone_number, button_id):
     """Procesa respuestas de botones"""
     if button_id == "consulta_doctor":
@@ -698,7 +3270,61 @@ def health_check():
     """Endpoint de salud"""
     return jsonify({"status": "ok"}), 200
 
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Métricas internas del bot"""
+    return jsonify(metrics.snapshot()), 200
+
+# ============================================================================
+# ARRANQUE DE LA APLICACIÓN
+# ============================================================================
+
+_background_started_pid = None
+
+def start_background_tasks():
+    """Construye la FAQ, precarga cachés, reanuda el spool y llena el pool de salas (una vez por proceso)"""
+    global _background_started_pid
+    if _background_started_pid == os.getpid():
+        return
+    _background_started_pid = os.getpid()
+    if os.path.exists(FAQ_FILE):
+        faq_retriever.load()
+    if REFERENCE_CACHE_WARMUP:
+        appointments_cache.start()
+        contact_phones_cache.start()
+    if WRITE_BEHIND_ENABLED and os.path.exists(SPOOL_DB_PATH):
+        # Reanuda las escrituras pendientes de una ejecución anterior
+        write_spool.start()
+    if MEETING_POOL_SIZE > 0:
+        zoom_room_pool.start()
+        meet_room_pool.start()
+
+def warmup():
+    """Carga por adelantado los SDK de proveedores y sus clientes"""
+    start = time.perf_counter()
+    if OPENAI_API_KEY:
+        get_openai_client()
+    if os.path.exists(GOOGLE_CREDENTIALS_FILE):
+        get_google_calendar_service()
+    metrics.observe("warmup_ms", (time.perf_counter() - start) * 1000)
+
+def create_app(warmup_hook=None):
+    """Fábrica de la aplicación para gunicorn: `gunicorn 'app:create_app()'`
+
+    Arranca las tareas en segundo plano del worker y, si APP_WARMUP=true o se
+    pasa `warmup_hook`, ejecuta el calentamiento antes de recibir tráfico.
+    """
+    start_background_tasks()
+    if warmup_hook is None and APP_WARMUP:
+        warmup_hook = warmup
+    if warmup_hook:
+        try:
+            warmup_hook()
+        except Exception as e:
+            print(f"Error en warmup: {e}")
+    return app
+
 if __name__ == '__main__':
     #port = int(os.getenv('PORT', 5000))
     #app.run(host='0.0.0.0', port=port, debug=True)
-    app.run(debug=True)
+    create_app().run(debug=True)
@@ -0,0 +1,4 @@
+import os
+
+# Los tests no deben consultar la API real al importar app.py
+os.environ.setdefault('REFERENCE_CACHE_WARMUP', 'false')
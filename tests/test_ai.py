@@ -0,0 +1,250 @@
+import os
+import sys
+import threading
+import time
+from types import SimpleNamespace
+
+import httpx
+import openai
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as bot
+
+
+def test_normalize_question_folds_accents_punctuation_and_stopwords():
+    assert bot.normalize_question("¡Me duele la rodilla!") == "duele rodilla"
+    assert bot.normalize_question("me duele la rodilla") == bot.normalize_question("Me DUELE la Rodílla...")
+
+
+def test_negation_changes_the_normalized_question():
+    assert bot.normalize_question("¿no debo operarme?") != bot.normalize_question("¿debo operarme?")
+    assert (bot.normalize_question("me duele la rodilla sin apoyar el pie")
+            != bot.normalize_question("me duele la rodilla al apoyar el pie"))
+    assert bot.normalize_question("¿sí puedo correr?") != bot.normalize_question("¿puedo correr?")
+
+
+def test_get_ai_response_serves_normalized_repeats_from_cache(monkeypatch):
+    calls = []
+    monkeypatch.setattr(bot, "ai_response_cache", bot.AIResponseCache(ttl=60, max_size=10))
+    monkeypatch.setattr(bot, "ask_openai", lambda q: calls.append(q) or "Aplica hielo y consulta.")
+
+    assert bot.get_ai_response("me duele la rodilla") == "Aplica hielo y consulta."
+    assert bot.get_ai_response("Me duele la rodilla!") == "Aplica hielo y consulta."
+    assert calls == ["me duele la rodilla"]
+
+
+def test_fallback_answers_are_not_cached(monkeypatch):
+    monkeypatch.setattr(bot, "ai_response_cache", bot.AIResponseCache(ttl=60, max_size=10))
+    monkeypatch.setattr(bot, "ask_openai", lambda q: bot.AI_FALLBACK_MESSAGE)
+
+    bot.get_ai_response("me duele el hombro")
+    assert bot.ai_response_cache.get("me duele el hombro") is None
+
+
+def test_near_duplicate_lookup_is_opt_in():
+    exact = bot.AIResponseCache(ttl=60, max_size=10)
+    near = bot.AIResponseCache(ttl=60, max_size=10, near_duplicates=True, similarity=0.6)
+    for cache in (exact, near):
+        cache.set("tengo mucho dolor en la rodilla derecha al caminar", "respuesta")
+
+    question = "tengo mucho dolor en la rodilla derecha cuando camino"
+    assert exact.get(question) is None
+    assert near.get(question) == "respuesta"
+    assert near.get("como agendo una cita") is None
+
+
+def fake_stream(deltas):
+    return [SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=d))]) for d in deltas]
+
+
+def test_streaming_reply_sends_first_sentence_then_paragraphs():
+    sent = []
+    reply = bot.StreamingReply(sent.append, min_chars=40, min_interval=0, max_messages=4)
+    for delta in ["Aplica ", "hielo.", " Eleva la pierna", " y descansa.", "\n\n", "Consulta ", "si no mejora."]:
+        reply.feed(delta)
+    assert sent == ["Aplica hielo.", "Eleva la pierna y descansa."]
+    reply.finish()
+    assert sent[-1] == "Consulta si no mejora."
+
+
+def test_streaming_reply_respects_interval_size_and_message_cap():
+    sent, times = [], []
+    reply = bot.StreamingReply(lambda text: sent.append(text) or times.append(time.monotonic()),
+                               max_length=50, min_chars=1, min_interval=0.05, max_messages=3)
+    reply.feed("Primera oración. Segunda oración. ")
+    reply.feed("Tercera. ")
+    assert sent == ["Primera oración. Segunda oración."]
+
+    reply.feed("palabra " * 20)
+    assert len(sent) == 1
+    time.sleep(0.06)
+    reply.feed(" ")
+    assert len(sent) == 2
+    reply.feed("más ")
+    assert len(sent) == 2
+
+    reply.finish()
+    assert all(len(text) <= 50 for text in sent)
+    assert all(b - a >= 0.05 for a, b in zip(times, times[1:]))
+    assert " ".join(sent).split() == ("Primera oración. Segunda oración. Tercera. " + "palabra " * 20 + "más").split()
+
+
+def test_stream_ai_response_delivers_chunks_and_caches_full_answer(monkeypatch):
+    sent, requests = [], []
+
+    def create(**kwargs):
+        requests.append(kwargs)
+        return fake_stream(["Reposo e hielo.", " Consulta", " si persiste."])
+
+    client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+    monkeypatch.setattr(bot, "get_openai_client", lambda: client)
+    monkeypatch.setattr(bot, "ai_response_cache", bot.AIResponseCache(ttl=60, max_size=10))
+    monkeypatch.setattr(bot, "send_whatsapp_message", lambda phone, text: sent.append(text))
+
+    answer = bot.stream_ai_response("57300", "me duele el codo")
+
+    assert requests[0]["stream"] is True
+    assert sent == ["Reposo e hielo.", "Consulta si persiste."]
+    assert bot.ai_response_cache.get("me duele el codo") == answer == "Reposo e hielo. Consulta si persiste."
+
+
+def test_doctor_chat_sends_budgeted_history_and_skips_cache(monkeypatch):
+    requests, sent = [], []
+
+    def create(**kwargs):
+        requests.append(kwargs["messages"])
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=f"respuesta {len(requests)}"))])
+
+    client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+    monkeypatch.setattr(bot, "get_openai_client", lambda: client)
+    monkeypatch.setattr(bot, "AI_STREAMING", False)
+    monkeypatch.setattr(bot, "faq_retriever", bot.FAQRetriever(path="no_existe.json"))
+    monkeypatch.setattr(bot, "ai_response_cache", bot.AIResponseCache(ttl=60, max_size=10))
+    monkeypatch.setattr(bot, "send_whatsapp_message", lambda phone, text: sent.append(text))
+    monkeypatch.setattr(bot, "AI_CONTEXT_MAX_TOKENS", 10_000)
+    bot.session_store.delete("57322")
+    bot.update_user_session("57322", state="doctor_chat")
+
+    bot.process_text_message("57322", "me operaron el menisco")
+    bot.process_text_message("57322", "¿cuándo puedo correr?")
+
+    assert sent == ["respuesta 1", "respuesta 2"]
+    assert [m["content"] for m in requests[1][1:]] == [
+        "me operaron el menisco", "respuesta 1", "¿cuándo puedo correr?"
+    ]
+    assert bot.ai_response_cache.get("¿cuándo puedo correr?") is None
+
+    monkeypatch.setattr(bot, "AI_CONTEXT_MAX_TOKENS", 0)
+    bot.process_text_message("57322", "¿y nadar?")
+    assert [m["role"] for m in requests[2]] == ["system", "user"]
+
+
+def test_context_stays_within_budget_and_summarizes_overflow(monkeypatch):
+    monkeypatch.setattr(bot, "summarize_conversation", lambda summary, turns: f"{len(turns)} turnos previos")
+    bot.session_store.delete("57323")
+    for n in range(6):
+        bot.record_conversation_turns("57323", f"pregunta {n} " * 10, f"respuesta {n} " * 10)
+
+    session = bot.get_user_session("57323")
+    context = bot.conversation_context(session, max_tokens=80)
+    assert sum(bot.count_tokens(m["content"]) for m in context) <= 80
+    assert context[-1]["content"].startswith("respuesta 5")
+
+    bot.compact_conversation("57323", session, max_tokens=80)
+    session = bot.get_user_session("57323")
+    assert session.data["context_summary"].endswith("turnos previos")
+    assert session.recent_turns(10_000)[1] == 0
+    assert len(session.conversation_history) < 12
+
+
+def test_priority_limiter_serves_chat_before_background_and_times_out():
+    limiter = bot.PriorityLimiter("llm_test", 1)
+    assert limiter.acquire(bot.LLM_PRIORITY_CHAT, 1)
+    order = []
+
+    def wait(priority, name):
+        if limiter.acquire(priority, 2):
+            order.append(name)
+            limiter.release()
+
+    threads = [threading.Thread(target=wait, args=(bot.LLM_PRIORITY_BACKGROUND, "resumen"))]
+    threads[0].start()
+    time.sleep(0.05)
+    threads.append(threading.Thread(target=wait, args=(bot.LLM_PRIORITY_CHAT, "chat")))
+    threads[1].start()
+    time.sleep(0.05)
+
+    assert limiter.stats()["queued"] == 2
+    assert not limiter.acquire(bot.LLM_PRIORITY_CHAT, 0.01)
+    limiter.release()
+    for thread in threads:
+        thread.join()
+    assert order == ["chat", "resumen"]
+
+
+def test_rate_limited_primary_falls_back_to_cheaper_model(monkeypatch):
+    models = []
+
+    def create(model, **kwargs):
+        models.append(model)
+        if model == "principal":
+            response = httpx.Response(429, request=httpx.Request("POST", "https://api.openai.com"))
+            raise openai.RateLimitError("rate limit", response=response, body=None)
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content="respuesta breve"))])
+
+    client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+    monkeypatch.setattr(bot, "get_openai_client", lambda: client)
+    monkeypatch.setattr(bot, "AI_MODEL", "principal")
+    monkeypatch.setattr(bot, "AI_FALLBACK_MODEL", "respaldo")
+
+    assert bot.ask_openai("me duele el tobillo") == "respuesta breve"
+    assert models == ["principal", "respaldo"]
+    assert bot.llm_limiter.in_flight == bot.llm_fallback_limiter.in_flight == 0
+
+
+def test_full_queues_answer_fallback_without_opening_circuit(monkeypatch):
+    monkeypatch.setattr(bot, "llm_limiter", bot.PriorityLimiter("llm_lleno", 0))
+    monkeypatch.setattr(bot, "llm_fallback_limiter", bot.PriorityLimiter("llm_respaldo_lleno", 0))
+    monkeypatch.setattr(bot, "AI_QUEUE_TIMEOUT", 0.01)
+    breaker = bot.circuit_breakers["openai"]
+
+    for _ in range(bot.CIRCUIT_FAILURE_THRESHOLD + 1):
+        assert bot.ask_openai("me duele la espalda") == bot.AI_FALLBACK_MESSAGE
+    assert breaker.state == breaker.CLOSED
+
+
+def test_real_openai_client_builds_with_pinned_httpx(monkeypatch):
+    monkeypatch.setattr(bot, "OPENAI_API_KEY", "sk-test")
+    monkeypatch.setattr(bot, "_openai_client", None)
+
+    client = bot.get_openai_client()
+
+    assert isinstance(client, openai.OpenAI)
+    assert client.max_retries == 0
+    assert bot.get_openai_client() is client
+
+
+def test_near_duplicates_never_cross_negation():
+    cache = bot.AIResponseCache(ttl=60, max_size=10, near_duplicates=True, similarity=0.7)
+    cache.set("debo operarme la rodilla derecha", "Sí, conviene operar.")
+
+    assert cache.get("no debo operarme la rodilla derecha") is None
+    assert cache.get("debo operarme de la rodilla derecha") == "Sí, conviene operar."
+
+
+def test_minhash_estimates_track_true_jaccard():
+    cache = bot.AIResponseCache(ttl=60, max_size=10, near_duplicates=True)
+
+    def shingles(key):
+        padded = f" {key} "
+        return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+    pairs = [("debo operarme rodilla", "no debo operarme rodilla"),
+             ("dolor rodilla derecha caminar", "dolor rodilla izquierda caminar"),
+             ("dolor hombro", "fractura tobillo")]
+    for a, b in pairs:
+        true = len(shingles(a) & shingles(b)) / len(shingles(a) | shingles(b))
+        sa, sb = cache._signature(a), cache._signature(b)
+        estimate = sum(x == y for x, y in zip(sa, sb)) / cache.NUM_HASHES
+        assert abs(estimate - true) < 0.2, (a, b, estimate, true)
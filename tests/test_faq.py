@@ -0,0 +1,113 @@
+"""Búsqueda en la FAQ local.
+
+Benchmark de latencia por tamaño de corpus: python tests/test_faq.py
+"""
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as bot
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def write_faq(path, entries):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(entries, f)
+
+
+def test_shipped_corpus_answers_paraphrases():
+    retriever = bot.FAQRetriever(path=os.path.join(ROOT, "faq_ortopedia.json"))
+
+    assert "Esguince" in retriever.answer("¿Me torcí el tobillo, qué hago?")
+    assert "calor" in retriever.answer("hielo o calor?")
+    assert retriever.answer("¿el doctor atiende los martes?") is None
+
+
+def test_generic_short_questions_fall_through_to_the_ai():
+    retriever = bot.FAQRetriever(path=os.path.join(ROOT, "faq_ortopedia.json"))
+
+    for question in ("tengo dolor", "me duele", "tengo una fractura", "rodilla", "dolor de espalda y fiebre alta"):
+        assert retriever.answer(question) is None, question
+
+
+def test_confidence_accounts_for_unmatched_document_terms():
+    index = bot.FAQIndex([
+        {"id": "a", "preguntas": ["dolor lumbar irradiado pierna izquierda"], "respuesta": "a"},
+        {"id": "b", "preguntas": ["dolor hombro"], "respuesta": "b"},
+    ])
+    _, partial = index.search("dolor lumbar")
+    entry, full = index.search("dolor de hombro")
+    assert partial < 0.6
+    assert entry["id"] == "b" and full > 0.9
+
+
+def test_index_reloads_when_file_changes(tmp_path):
+    path = tmp_path / "faq.json"
+    write_faq(path, [{"id": "a", "preguntas": ["dolor de hombro"], "respuesta": "v1"}])
+    retriever = bot.FAQRetriever(path=str(path), threshold=0.5, reload_interval=0)
+    assert retriever.answer("dolor de hombro") == "v1"
+
+    write_faq(path, [{"id": "a", "preguntas": ["dolor de hombro"], "respuesta": "v2"}])
+    os.utime(path, (time.time() + 5, time.time() + 5))
+    retriever.answer("dolor de hombro")
+    deadline = time.time() + 2
+    while retriever.answer("dolor de hombro") != "v2" and time.time() < deadline:
+        time.sleep(0.01)
+    assert retriever.answer("dolor de hombro") == "v2"
+
+
+def test_broken_file_keeps_previous_index(tmp_path):
+    path = tmp_path / "faq.json"
+    write_faq(path, [{"id": "a", "preguntas": ["dolor de hombro"], "respuesta": "v1"}])
+    retriever = bot.FAQRetriever(path=str(path), threshold=0.5)
+    assert retriever.load()
+
+    path.write_text("{roto", encoding="utf-8")
+    assert not retriever.load()
+    assert retriever.answer("dolor de hombro") == "v1"
+
+
+def test_doctor_chat_uses_faq_before_ai(monkeypatch, tmp_path):
+    path = tmp_path / "faq.json"
+    write_faq(path, [{"id": "a", "preguntas": ["hielo o calor"], "respuesta": "Hielo primero."}])
+    sent, asked = [], []
+    monkeypatch.setattr(bot, "faq_retriever", bot.FAQRetriever(path=str(path)))
+    monkeypatch.setattr(bot, "AI_STREAMING", False)
+    monkeypatch.setattr(bot, "get_ai_response", lambda q, history=None: asked.append(q) or "Respuesta IA")
+    monkeypatch.setattr(bot, "send_whatsapp_message", lambda phone, text: sent.append(text))
+    bot.update_user_session("57311", state="doctor_chat")
+
+    bot.process_text_message("57311", "¿hielo o calor?")
+    bot.process_text_message("57311", "¿puedo nadar con una prótesis de cadera?")
+
+    assert sent == ["Hielo primero.", "Respuesta IA"]
+    assert asked == ["¿puedo nadar con una prótesis de cadera?"]
+
+
+def synthetic_corpus(size, vocabulary=5000, seed=7):
+    rng = random.Random(seed)
+    words = [f"termino{n}" for n in range(vocabulary)]
+    return [
+        {"id": str(n), "preguntas": [" ".join(rng.sample(words, 6))], "respuesta": f"respuesta {n}"}
+        for n in range(size)
+    ]
+
+
+if __name__ == "__main__":
+    print("Latencia de consulta a la FAQ por tamaño de corpus")
+    for size in (100, 1_000, 10_000, 100_000):
+        corpus = synthetic_corpus(size)
+        start = time.perf_counter()
+        index = bot.FAQIndex(corpus)
+        build_ms = (time.perf_counter() - start) * 1000
+        queries = [entry["preguntas"][0] for entry in random.Random(1).sample(corpus, min(200, size))]
+        start = time.perf_counter()
+        for question in queries:
+            index.search(question)
+        query_us = (time.perf_counter() - start) / len(queries) * 1e6
+        print(f"  {size:>7} preguntas: construcción {build_ms:8.1f} ms | consulta {query_us:7.1f} µs")
@@ -0,0 +1,44 @@
+"""Mide el arranque en frío (import de app.py) en un intérprete nuevo.
+
+Ejecutar: python tests/test_import_time.py
+"""
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PROVIDER_SDKS = ("openai", "jwt", "google.oauth2.service_account", "googleapiclient.discovery")
+IMPORT_BUDGET_SECONDS = float(os.getenv('IMPORT_BUDGET_SECONDS', '3'))
+
+SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps({{"seconds": elapsed, "loaded": [m for m in {sdks!r} if m in sys.modules]}}))
+"""
+
+
+def measure_import(module="app"):
+    env = dict(os.environ, REFERENCE_CACHE_WARMUP="false", PYTHONDONTWRITEBYTECODE="1")
+    result = subprocess.run(
+        [sys.executable, "-c", SCRIPT.format(module=module, sdks=PROVIDER_SDKS)],
+        cwd=ROOT, env=env, capture_output=True, text=True, check=True
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def test_cold_import_skips_provider_sdks():
+    result = measure_import()
+    print(f"Arranque en frío de app.py: {result['seconds'] * 1000:.0f} ms")
+
+    assert result["loaded"] == []
+    assert result["seconds"] < IMPORT_BUDGET_SECONDS
+
+
+if __name__ == "__main__":
+    app_import = measure_import()
+    sdk_import = measure_import("openai, googleapiclient.discovery, google.oauth2.service_account")
+    print(f"app.py (SDK perezosos): {app_import['seconds'] * 1000:.0f} ms")
+    print(f"Solo los SDK de proveedores: {sdk_import['seconds'] * 1000:.0f} ms ahorrados por worker")
@@ -0,0 +1,186 @@
+import os
+import sys
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as bot
+
+
+def use_patient_api(monkeypatch, handler):
+    client = bot.PatientApiClient(base_url="https://api.test/api", transport=httpx.MockTransport(handler))
+    monkeypatch.setattr(bot, "patient_api", client)
+    return client
+
+
+def test_validate_cedula_caches_found_and_missing(monkeypatch):
+    calls = []
+    patients = {"111": {"id": 1, "nombre": "Ana"}}
+
+    def handler(request):
+        if request.method == "POST":
+            return httpx.Response(201, json={"id": 2})
+        cedula = request.url.path.rsplit("/", 1)[-1]
+        calls.append(cedula)
+        if cedula in patients:
+            return httpx.Response(200, json=patients[cedula])
+        return httpx.Response(404, json={"error": "Paciente no encontrado"})
+
+    monkeypatch.setattr(bot, "cedula_cache", bot.LookupCache("cedula_test", 60, 60, 100))
+    use_patient_api(monkeypatch, handler)
+
+    assert bot.validate_cedula("111")["nombre"] == "Ana"
+    assert bot.validate_cedula("111")["nombre"] == "Ana"
+    assert bot.validate_cedula("222") is None
+    assert bot.validate_cedula("222") is None
+    assert calls == ["111", "222"]
+
+    patients["222"] = {"id": 2, "nombre": "Luis"}
+    bot.create_patient("222", "Luis", "Gómez")
+    assert bot.validate_cedula("222")["nombre"] == "Luis"
+    assert bot.cedula_cache.stats()["hit_rate"] == 0.4
+
+
+def test_refreshing_cache_serves_stale_value_when_refresh_fails():
+    import time
+
+    state = {"calls": 0, "fail": False}
+
+    def loader():
+        state["calls"] += 1
+        if state["fail"]:
+            raise RuntimeError("API caída")
+        return [{"id": state["calls"]}]
+
+    cache = bot.RefreshingCache("citas_test", loader, interval=0.01, default=[])
+    assert cache.get() == [{"id": 1}]
+
+    state["fail"] = True
+    time.sleep(0.02)
+    start = time.perf_counter()
+    assert cache.get() == [{"id": 1}]
+    assert time.perf_counter() - start < 0.005
+    time.sleep(0.05)
+    assert cache.get() == [{"id": 1}]
+    assert cache.stats()["last_error"] == "API caída"
+
+    state["fail"] = False
+    assert cache.refresh()
+    assert cache.get()[0]["id"] > 1
+
+
+def test_concurrent_identical_gets_share_one_request(monkeypatch):
+    import threading
+    import time
+
+    calls = []
+
+    def handler(request):
+        calls.append(str(request.url))
+        time.sleep(0.05)
+        return httpx.Response(200, json=[{"id": 1, "fecha": "2025-10-15"}])
+
+    client = use_patient_api(monkeypatch, handler)
+    before = bot.metrics.get("patient_api_coalesced")
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(client.get("appointments", "/citas/disponibles").json()))
+        for _ in range(10)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+    assert results == [[{"id": 1, "fecha": "2025-10-15"}]] * 10
+    assert bot.metrics.get("patient_api_coalesced") - before == 9
+
+
+def test_patient_api_client_uses_endpoint_timeouts_and_adapts_limit(monkeypatch):
+    seen = []
+
+    def handler(request):
+        seen.append((request.url.path, request.extensions["timeout"]["read"]))
+        status = 503 if request.url.path.endswith("/estudios") else 200
+        return httpx.Response(status, json={})
+
+    client = use_patient_api(monkeypatch, handler)
+    client.timeouts = {"validate_cedula": 3}
+    start_limit = client.limiter.limit
+
+    client.get("validate_cedula", "/pacientes/cedula/111")
+    assert seen[-1] == ("/api/pacientes/cedula/111", 3)
+    assert client.limiter.limit > start_limit
+
+    client.post("medical_image", "/estudios", {"patient_id": 1})
+    assert seen[-1] == ("/api/estudios", client.default_timeout)
+    assert client.limiter.limit < start_limit
+
+
+def test_adaptive_limiter_rejects_when_saturated():
+    limiter = bot.AdaptiveLimiter("limiter_test", 1, 1, 4, 100, queue_timeout=0.01)
+
+    assert limiter.acquire()
+    assert not limiter.acquire()
+    limiter.release(10, ok=True)
+    assert limiter.acquire()
+
+
+def test_write_behind_spool_retries_and_flushes(monkeypatch, tmp_path):
+    responses = [503, 201, 400]
+    posted = []
+
+    def handler(request):
+        posted.append(request.url.path)
+        return httpx.Response(responses.pop(0), json={})
+
+    use_patient_api(monkeypatch, handler)
+    spool = bot.WriteBehindSpool(path=str(tmp_path / "spool.db"))
+    monkeypatch.setattr(spool, "start", lambda: None)
+    monkeypatch.setattr(bot, "write_spool", spool)
+    monkeypatch.setattr(bot, "WRITE_BEHIND_ENABLED", True)
+
+    assert bot.save_video_call_info(1, "zoom", "https://zoom.us/j/1", 1) == {"status": "queued"}
+    assert bot.save_medical_image(1, "https://img", "rx") == {"status": "queued"}
+    assert posted == []
+    assert spool.stats() == {"depth": 2, "dead": 0}
+
+    assert spool.flush_once() == 2
+    assert posted == ["/api/videollamadas", "/api/estudios"]
+    assert spool.stats() == {"depth": 1, "dead": 0}
+
+    spool._conn().execute("UPDATE spool SET next_attempt = 0")
+    spool.flush_once()
+    assert spool.stats() == {"depth": 0, "dead": 1}
+
+
+def test_write_behind_spool_survives_long_outages(monkeypatch, tmp_path):
+    def handler(request):
+        return httpx.Response(503, json={})
+
+    use_patient_api(monkeypatch, handler)
+    spool = bot.WriteBehindSpool(path=str(tmp_path / "spool.db"), max_age_hours=1)
+    monkeypatch.setattr(spool, "start", lambda: None)
+    spool.enqueue("videollamadas", "/videollamadas", {"patient_id": 1})
+
+    # Con el circuito abierto la escritura se reprograma sin gastar intentos
+    monkeypatch.setattr(bot.circuit_breakers["patient_api"], "allow", lambda: False)
+    for _ in range(20):
+        spool._conn().execute("UPDATE spool SET next_attempt = 0")
+        spool.flush_once()
+    assert spool._conn().execute("SELECT attempts, status FROM spool").fetchone() == (0, "pending")
+    monkeypatch.undo()
+
+    use_patient_api(monkeypatch, handler)
+    monkeypatch.setattr(bot.circuit_breakers["patient_api"], "allow", lambda: True)
+    monkeypatch.setattr(bot.circuit_breakers["patient_api"], "record", lambda ok: None)
+    for _ in range(15):
+        spool._conn().execute("UPDATE spool SET next_attempt = 0")
+        spool.flush_once()
+    assert spool._conn().execute("SELECT attempts, status FROM spool").fetchone() == (15, "pending")
+
+    spool._conn().execute("UPDATE spool SET next_attempt = 0, created_at = created_at - 7200")
+    spool.flush_once()
+    assert spool.stats() == {"depth": 0, "dead": 1}
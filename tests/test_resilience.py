@@ -0,0 +1,346 @@
+import os
+import sqlite3
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as bot
+
+
+def test_circuit_breaker_opens_and_recovers_through_half_open():
+    breaker = bot.CircuitBreaker("cb_test", failure_threshold=2, reset_timeout=0.05)
+
+    for _ in range(2):
+        assert breaker.allow()
+        breaker.record(False)
+    assert breaker.state == "open"
+    assert not breaker.allow()
+
+    time.sleep(0.06)
+    assert breaker.allow()
+    assert breaker.state == "half_open"
+    assert not breaker.allow()
+    breaker.record(True)
+
+    assert breaker.state == "closed"
+    assert bot.metrics.get("circuit_cb_test_closed_to_open") == 1
+    assert bot.metrics.get("circuit_cb_test_half_open_to_closed") == 1
+
+
+def test_open_circuit_fails_fast_with_spanish_fallback(monkeypatch):
+    calls = []
+    breaker = bot.CircuitBreaker("openai", failure_threshold=1, reset_timeout=60)
+    monkeypatch.setitem(bot.circuit_breakers, "openai", breaker)
+
+    def failing_client():
+        calls.append(1)
+        raise RuntimeError("timeout")
+
+    monkeypatch.setattr(bot, "get_openai_client", failing_client)
+
+    assert bot.get_ai_response("me duele la rodilla") == bot.AI_FALLBACK_MESSAGE
+    assert breaker.state == "open"
+    assert bot.get_ai_response("me duele el hombro") == bot.AI_FALLBACK_MESSAGE
+    assert len(calls) == 1
+
+
+class FakeZoomResponse:
+    def __init__(self, status_code, payload):
+        self.status_code = status_code
+        self._payload = payload
+
+    def json(self):
+        return self._payload
+
+
+def test_zoom_token_is_reused_and_refreshed_once_after_401(monkeypatch):
+    token_calls = []
+    meeting_tokens = []
+
+    def fake_post(url, headers=None, **kwargs):
+        if url == bot.ZoomTokenManager.TOKEN_URL:
+            token_calls.append(url)
+            return FakeZoomResponse(200, {"access_token": f"tok-{len(token_calls)}", "expires_in": 3600})
+        meeting_tokens.append(headers["Authorization"])
+        if headers["Authorization"] == "Bearer tok-1" and len(meeting_tokens) == 3:
+            return FakeZoomResponse(401, {})
+        return FakeZoomResponse(201, {"join_url": "https://zoom.us/j/1", "id": 1, "start_time": "2025-10-15T10:00:00Z"})
+
+    monkeypatch.setattr(bot, "zoom_tokens", bot.ZoomTokenManager())
+    monkeypatch.setitem(bot.circuit_breakers, "zoom", bot.CircuitBreaker("zoom"))
+    monkeypatch.setattr(bot.requests, "post", fake_post)
+
+    assert bot.create_zoom_meeting("Consulta", 30)
+    assert bot.create_zoom_meeting("Consulta", 30)
+    assert len(token_calls) == 1
+
+    assert bot.create_zoom_meeting("Consulta", 30)
+    assert len(token_calls) == 2
+    assert meeting_tokens[-2:] == ["Bearer tok-1", "Bearer tok-2"]
+
+
+def test_google_calendar_service_is_built_once_per_thread(monkeypatch):
+    import threading
+
+    from google.auth.credentials import AnonymousCredentials
+
+    loads = []
+
+    def fake_from_file(path, scopes=None):
+        loads.append(path)
+        return AnonymousCredentials()
+
+    monkeypatch.setattr(bot, "_google_calendar_base", None)
+    monkeypatch.setattr(bot, "_google_calendar_local", threading.local())
+    from google.oauth2 import service_account
+
+    monkeypatch.setattr(service_account.Credentials, "from_service_account_file", fake_from_file)
+
+    first = bot.get_google_calendar_service()
+    assert first is bot.get_google_calendar_service()
+
+    other = []
+    thread = threading.Thread(target=lambda: other.append(bot.get_google_calendar_service()))
+    thread.start()
+    thread.join()
+
+    assert other[0] is not None and other[0] is not first
+    assert len(loads) == 1
+
+
+def test_meeting_pool_hands_out_rooms_and_expires_unused(monkeypatch):
+    created = []
+    discarded = []
+
+    def factory():
+        created.append(len(created) + 1)
+        return {"meeting_id": created[-1]}
+
+    pool = bot.MeetingPool("pool_test", factory, discarded.append, size=2, ttl=0.1)
+    assert pool.take() is None
+
+    deadline = time.time() + 1
+    while len(pool._rooms) < 2 and time.time() < deadline:
+        time.sleep(0.01)
+    assert pool.take()["meeting_id"] == 1
+
+    time.sleep(0.15)
+    while pool._refilling:
+        time.sleep(0.01)
+    assert pool.take() is None
+    assert discarded
+    assert bot.metrics.get("meeting_pool_pool_test_hits") == 1
+    assert bot.metrics.get("meeting_pool_pool_test_misses") == 2
+
+
+def test_video_call_falls_back_to_other_platform_after_timeout(monkeypatch):
+    sent = []
+    saved = []
+    offered = []
+    meet = {"platform": "google_meet", "meet_link": "https://meet.google.com/abc",
+            "event_id": "ev1", "start_time": "2025-10-15T10:00:00-05:00"}
+
+    def slow_zoom(**kwargs):
+        time.sleep(0.2)
+        return {"platform": "zoom", "meeting_id": 9}
+
+    monkeypatch.setattr(bot, "VIDEO_CALL_TIMEOUT", 0.05)
+    monkeypatch.setattr(bot, "create_zoom_meeting", slow_zoom)
+    monkeypatch.setattr(bot, "create_google_meet_meeting", lambda **kwargs: meet)
+    monkeypatch.setattr(bot.zoom_room_pool, "offer", offered.append)
+    monkeypatch.setattr(bot, "send_whatsapp_message", lambda phone, text: sent.append(text))
+    monkeypatch.setattr(bot, "save_video_call_info", lambda *args: saved.append(args))
+
+    bot.provision_video_call("57300", "zoom", {"nombre": "Ana", "patient_id": 7})
+
+    assert "Zoom no está respondiendo" in sent[0]
+    assert "https://meet.google.com/abc" in sent[1]
+    assert saved == [(7, "google_meet", "https://meet.google.com/abc", "ev1")]
+    time.sleep(0.25)
+    assert offered == [{"platform": "zoom", "meeting_id": 9}]
+
+
+def test_repeat_video_call_request_reuses_active_meeting(monkeypatch):
+    from datetime import datetime, timezone
+
+    created = []
+    sent = []
+    zoom = {"platform": "zoom", "join_url": "https://zoom.us/j/5", "meeting_id": 5, "password": "x",
+            "start_time": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")}
+
+    monkeypatch.setattr(bot, "session_store", bot.InMemorySessionStore())
+    monkeypatch.setattr(bot, "VIDEO_CALL_ASYNC", False)
+    monkeypatch.setattr(bot, "create_zoom_meeting", lambda **kwargs: created.append(1) or zoom)
+    monkeypatch.setattr(bot, "send_whatsapp_message", lambda phone, text: sent.append(text))
+    monkeypatch.setattr(bot, "save_video_call_info", lambda *args: None)
+
+    bot.handle_video_call_zoom("57300")
+    bot.handle_video_call_zoom("57300")
+
+    assert len(created) == 1
+    assert sent[-1].startswith("ℹ️ Ya tienes una videollamada programada")
+    assert "https://zoom.us/j/5" in sent[-1]
+
+    monkeypatch.setattr(bot, "create_google_meet_meeting", lambda **kwargs: None)
+    bot.session_store.update("57300", lambda s: s.data["active_meetings"]["zoom"].update(expires_at=0))
+    bot.handle_video_call_zoom("57300")
+    assert len(created) == 2
+
+
+def test_async_double_tap_creates_a_single_meeting(monkeypatch):
+    from datetime import datetime, timezone
+
+    created = []
+    sent = []
+    zoom = {"platform": "zoom", "join_url": "https://zoom.us/j/6", "meeting_id": 6, "password": "x",
+            "start_time": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")}
+
+    def slow_zoom(**kwargs):
+        created.append(1)
+        time.sleep(0.3)
+        return zoom
+
+    monkeypatch.setattr(bot, "session_store", bot.InMemorySessionStore())
+    monkeypatch.setattr(bot, "VIDEO_CALL_ASYNC", True)
+    monkeypatch.setattr(bot, "create_zoom_meeting", slow_zoom)
+    monkeypatch.setattr(bot, "send_whatsapp_message", lambda phone, text: sent.append(text))
+    monkeypatch.setattr(bot, "save_video_call_info", lambda *args: None)
+
+    bot.handle_video_call_zoom("57301")
+    bot.handle_video_call_zoom("57301")
+    assert sent[-1].startswith("⏳ Ya estamos creando tu sala de Zoom")
+
+    deadline = time.time() + 2
+    while bot.get_user_session("57301").data["video_calls_pending"] and time.time() < deadline:
+        time.sleep(0.01)
+    bot.handle_video_call_zoom("57301")
+
+    assert len(created) == 1
+    assert sum("✅ *Videollamada Zoom Creada*" in text and not text.startswith("ℹ️") for text in sent) == 1
+    assert sent[-1].startswith("ℹ️ Ya tienes una videollamada programada")
+
+
+def test_video_call_claim_is_shared_between_workers(monkeypatch, tmp_path):
+    path = str(tmp_path / "sessions.db")
+    worker_a = bot.SQLiteSessionStore(path=path)
+    worker_b = bot.SQLiteSessionStore(path=path)
+
+    monkeypatch.setattr(bot, "session_store", worker_a)
+    assert bot.claim_video_call("57303", "zoom")
+    monkeypatch.setattr(bot, "session_store", worker_b)
+    assert not bot.claim_video_call("57303", "zoom")
+    assert bot.claim_video_call("57303", "google_meet")
+
+    # Una marca huérfana (worker caído) no bloquea para siempre
+    monkeypatch.setattr(bot, "VIDEO_CALL_PENDING_TTL", 0)
+    assert bot.claim_video_call("57303", "zoom")
+    monkeypatch.setattr(bot, "VIDEO_CALL_PENDING_TTL", 120)
+    bot.release_video_call("57303", "zoom")
+    monkeypatch.setattr(bot, "session_store", worker_a)
+    assert bot.claim_video_call("57303", "zoom")
+
+
+def test_meeting_pool_upkeep_expires_without_recreating_and_cleans_up_on_close(monkeypatch):
+    created = []
+    discarded = []
+
+    def factory():
+        created.append(len(created) + 1)
+        return {"meeting_id": created[-1], "start_time": "2025-01-01T00:00:00Z"}
+
+    pool = bot.MeetingPool("pool_upkeep", factory, discarded.append, size=1, ttl=0.2)
+    monkeypatch.setattr(pool, "maintenance_interval", 0.05)
+    monkeypatch.setattr(bot.atexit, "register", lambda func: None)
+    pool.start()
+
+    time.sleep(0.5)
+    # Sin tráfico: la sala vencida se elimina pero no se crea otra
+    assert created == [1]
+    assert discarded == [{"meeting_id": 1, "start_time": "2025-01-01T00:00:00Z"}]
+    assert pool.take() is None
+
+    deadline = time.time() + 1
+    while not pool._rooms and time.time() < deadline:
+        time.sleep(0.01)
+    room = pool.take()
+    assert room["meeting_id"] == 2
+    assert room["start_time"] != "2025-01-01T00:00:00Z"
+
+    while len(pool._rooms) < 1 and time.time() < deadline:
+        time.sleep(0.01)
+    pool.close()
+    assert not pool._rooms
+    assert [r["meeting_id"] for r in discarded] == [1, 3]
+
+
+def test_video_call_job_failures_reach_the_patient(monkeypatch):
+    sent = []
+    zoom = {"platform": "zoom", "join_url": "https://zoom.us/j/8", "meeting_id": 8, "password": "x",
+            "start_time": "2025-10-15T10:00:00-05:00"}
+
+    def broken_session_write(phone_number, meeting):
+        raise sqlite3.OperationalError("database is locked")
+
+    monkeypatch.setattr(bot, "send_whatsapp_message", lambda phone, text: sent.append(text))
+    monkeypatch.setattr(bot, "save_video_call_info", lambda *args: None)
+    monkeypatch.setattr(bot, "create_zoom_meeting", lambda **kwargs: zoom)
+    monkeypatch.setattr(bot, "remember_active_meeting", broken_session_write)
+
+    bot.run_video_call_job("57302", "zoom", {"nombre": "Ana"})
+    assert "https://zoom.us/j/8" in sent[-1]
+
+    def broken_provision(*args):
+        raise RuntimeError("fallo inesperado")
+
+    monkeypatch.setattr(bot, "provision_video_call", broken_provision)
+    bot.run_video_call_job("57302", "zoom", {"nombre": "Ana"})
+    assert sent[-1].startswith("❌ Ocurrió un error creando tu videollamada")
+    assert "zoom" not in bot.get_user_session("57302").data.get("video_calls_pending", {})
+
+
+def test_provider_errors_are_not_counted_as_timeouts(monkeypatch):
+    def failing_zoom(**kwargs):
+        raise ValueError("credenciales inválidas")
+
+    monkeypatch.setattr(bot, "create_zoom_meeting", failing_zoom)
+    timeouts = bot.metrics.get("video_call_zoom_timeouts")
+    errors = bot.metrics.get("video_call_zoom_errors")
+
+    assert bot._create_with_timeout("zoom", "Ana") is None
+    assert bot.metrics.get("video_call_zoom_timeouts") == timeouts
+    assert bot.metrics.get("video_call_zoom_errors") == errors + 1
+
+
+def test_meet_events_use_unique_request_ids_and_require_a_link(monkeypatch):
+    inserted, deleted = [], []
+
+    class Call:
+        def __init__(self, result):
+            self.result = result
+
+        def execute(self):
+            return self.result
+
+    class Events:
+        def insert(self, calendarId, body, conferenceDataVersion):
+            inserted.append(body["conferenceData"]["createRequest"]["requestId"])
+            event = {"id": f"ev{len(inserted)}", "start": {"dateTime": body["start"]["dateTime"]}}
+            if len(inserted) == 1:
+                event["hangoutLink"] = "https://meet.google.com/xyz"
+            return Call(event)
+
+        def delete(self, calendarId, eventId):
+            deleted.append(eventId)
+            return Call(None)
+
+    service = type("Service", (), {"events": lambda self: Events()})()
+    monkeypatch.setattr(bot, "get_google_calendar_service", lambda: service)
+
+    first = bot.create_google_meet_meeting(summary="Consulta")
+    second = bot.create_google_meet_meeting(summary="Consulta")
+
+    assert first["meet_link"] == "https://meet.google.com/xyz"
+    assert second is None
+    assert deleted == ["ev2"]
+    assert len(set(inserted)) == 2
@@ -0,0 +1,57 @@
+"""Compara la memoria por sesión del layout compacto contra el dict original.
+
+Ejecutar: python tests/test_session_memory.py
+"""
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import Session
+
+
+def legacy_session(i, turns):
+    session = {
+        "state": "doctor_chat",
+        "data": {"nombre": f"Paciente {i}", "patient_id": i},
+        "conversation_history": []
+    }
+    for n in range(turns):
+        session["conversation_history"].append({"role": "user", "content": f"pregunta {i}-{n}"})
+    return session
+
+
+def compact_session(i, turns):
+    session = Session("doctor_chat", {"nombre": f"Paciente {i}", "patient_id": i})
+    for n in range(turns):
+        session.add_turn("user", f"pregunta {i}-{n}")
+    return session
+
+
+def bytes_per_session(factory, users, turns):
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    sessions = {f"57300{i:07d}": factory(i, turns) for i in range(users)}
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    total = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    assert len(sessions) == users
+    return total / users
+
+
+def test_compact_session_uses_less_memory():
+    for turns in (0, 4):
+        legacy = bytes_per_session(legacy_session, 5000, turns)
+        compact = bytes_per_session(compact_session, 5000, turns)
+        assert compact < legacy
+
+
+if __name__ == "__main__":
+    users = 100_000
+    print(f"Bytes por sesión con {users} usuarios activos")
+    for turns in (0, 4, 20):
+        legacy = bytes_per_session(legacy_session, users, turns)
+        compact = bytes_per_session(compact_session, users, turns)
+        print(f"  {turns:>2} turnos: dict {legacy:8.0f} B | Session {compact:8.0f} B "
+              f"({100 * (1 - compact / legacy):.0f}% menos)")
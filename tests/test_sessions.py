@@ -0,0 +1,116 @@
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as bot
+
+
+def test_memory_store_evicts_by_size_and_idle_ttl():
+    store = bot.InMemorySessionStore(ttl=0.05, max_size=2)
+    store.save("a", bot.new_session())
+    store.save("b", bot.new_session())
+    store.get("a")
+    store.save("c", bot.new_session())
+
+    assert store.get("b") is None
+    assert store.stats()["size"] == 2
+
+    time.sleep(0.06)
+    assert store.get("a") is None
+    assert store.stats()["size"] == 0
+
+
+def test_sqlite_store_roundtrip_and_prune(tmp_path):
+    store = bot.SQLiteSessionStore(path=str(tmp_path / "sessions.db"), ttl=60, max_size=1)
+    session = bot.new_session()
+    session.state = "awaiting_cedula"
+    store.save("57300", session)
+    store.save("57301", bot.new_session())
+
+    assert store.get("57300").state == "awaiting_cedula"
+
+    store.prune()
+    assert store.stats()["size"] == 1
+    assert store.get("57300").state == "awaiting_cedula"
+
+
+def test_update_user_session_goes_through_store(monkeypatch, tmp_path):
+    monkeypatch.setattr(bot, "session_store", bot.SQLiteSessionStore(path=str(tmp_path / "s.db")))
+
+    bot.update_user_session("57300", state="doctor_chat", data={"nombre": "Ana"})
+
+    session = bot.get_user_session("57300")
+    assert session.state == "doctor_chat"
+    assert session.data == {"nombre": "Ana"}
+
+
+def _increment_visits(path, times):
+    store = bot.SQLiteSessionStore(path=path)
+    for _ in range(times):
+        store.update("57300", lambda s: s.data.update(visits=s.data.get("visits", 0) + 1))
+
+
+def test_sqlite_update_is_atomic_across_processes(tmp_path):
+    import multiprocessing
+
+    path = str(tmp_path / "shared.db")
+    bot.SQLiteSessionStore(path=path)
+    ctx = multiprocessing.get_context("fork")
+    workers = [ctx.Process(target=_increment_visits, args=(path, 50)) for _ in range(4)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    assert bot.SQLiteSessionStore(path=path).get("57300").data["visits"] == 200
+
+
+def test_history_ring_buffer_keeps_latest_turns(monkeypatch):
+    monkeypatch.setattr(bot.Session, "HISTORY_SIZE", 3)
+    monkeypatch.setattr(bot.Session, "HOT_TURNS", 1)
+    monkeypatch.setattr(bot.Session, "COMPRESS_HISTORY", True)
+    session = bot.Session()
+    long_answer = "La tendinitis rotuliana mejora con reposo relativo. " * 10
+
+    for n in range(5):
+        session.add_turn("user", f"pregunta {n}")
+        session.add_turn("assistant", long_answer)
+
+    history = session.conversation_history
+    assert [t["content"] for t in history] == [long_answer, "pregunta 4", long_answer]
+    assert any(isinstance(content, bytes) for _, content, _ in session._history)
+    assert bot.Session.from_dict(session.to_dict()).conversation_history == history
+
+
+def test_recent_turns_fit_token_budget_using_cached_counts(monkeypatch):
+    session = bot.Session()
+    for n in range(4):
+        session.add_turn("user", f"pregunta {n}", tokens=10)
+    monkeypatch.setattr(bot, "count_tokens", lambda text: pytest.fail("recuento innecesario"))
+
+    turns, evicted = session.recent_turns(25)
+    assert [t["content"] for t in turns] == ["pregunta 2", "pregunta 3"]
+    assert evicted == 2
+
+    session.drop_oldest(evicted)
+    restored = bot.Session.from_dict(session.to_dict())
+    assert restored.recent_turns(100) == (turns, 0)
+
+
+def test_memory_stats_estimate_does_not_walk_every_session():
+    store = bot.InMemorySessionStore(ttl=60, max_size=10_000)
+    for n in range(5000):
+        store.update(f"57300{n:05d}", lambda s: s.add_turn("user", "me duele la rodilla", tokens=5))
+
+    start = time.perf_counter()
+    stats = store.stats()
+    elapsed = time.perf_counter() - start
+
+    exact = bot._deep_sizeof(store._sessions)
+    assert stats["size"] == 5000
+    assert 0.7 * exact < stats["memory_bytes"] < 1.3 * exact
+    assert elapsed < 0.1
@@ -0,0 +1,162 @@
+import os
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as bot
+
+
+def text_payload(phone, body, message_id=None):
+    message_id = message_id or f"wamid.{uuid.uuid4().hex}"
+    return {
+        "entry": [{
+            "changes": [{
+                "value": {
+                    "messages": [{
+                        "id": message_id,
+                        "from": phone,
+                        "type": "text",
+                        "text": {"body": body}
+                    }]
+                }
+            }]
+        }]
+    }
+
+
+def test_dispatcher_keeps_per_user_order():
+    dispatcher = bot.MessageDispatcher(workers=4, queue_size=100)
+    seen = {"a": [], "b": []}
+
+    def handle(phone, n):
+        time.sleep(0.001)
+        seen[phone].append(n)
+
+    for n in range(20):
+        assert dispatcher.submit("a", handle, "a", n)
+        assert dispatcher.submit("b", handle, "b", n)
+    dispatcher.join()
+
+    assert seen["a"] == list(range(20))
+    assert seen["b"] == list(range(20))
+
+
+def test_async_webhook_acknowledges_before_processing(monkeypatch):
+    processed = []
+
+    def slow_dispatch(message):
+        time.sleep(0.2)
+        processed.append(message["from"])
+
+    monkeypatch.setattr(bot, "WEBHOOK_ASYNC", True)
+    monkeypatch.setattr(bot, "dispatch_message", slow_dispatch)
+    client = bot.app.test_client()
+
+    start = time.perf_counter()
+    response = client.post("/webhook", json=text_payload("57300", "hola"))
+    elapsed = time.perf_counter() - start
+
+    assert response.status_code == 200
+    assert elapsed < 0.2
+    bot.message_dispatcher.join()
+    assert processed == ["57300"]
+
+
+def test_webhook_processes_every_message_in_batch(monkeypatch):
+    processed = []
+    monkeypatch.setattr(bot, "WEBHOOK_ASYNC", False)
+    monkeypatch.setattr(bot, "dispatch_message", lambda m: processed.append((m["from"], m["text"]["body"])))
+
+    payload = text_payload("57300", "uno")
+    payload["entry"][0]["changes"][0]["value"]["messages"].append(
+        text_payload("57300", "dos")["entry"][0]["changes"][0]["value"]["messages"][0]
+    )
+    payload["entry"].append(text_payload("57301", "otro")["entry"][0])
+
+    response = bot.app.test_client().post("/webhook", json=payload)
+
+    assert response.status_code == 200
+    assert sorted(processed) == [("57300", "dos"), ("57300", "uno"), ("57301", "otro")]
+    assert [p for p in processed if p[0] == "57300"] == [("57300", "uno"), ("57300", "dos")]
+    assert bot.metrics.snapshot()["observations"]["webhook_messages_per_post"]["max"] >= 3
+
+
+def test_redelivered_message_is_processed_once(monkeypatch):
+    processed = []
+    monkeypatch.setattr(bot, "WEBHOOK_ASYNC", False)
+    monkeypatch.setattr(bot, "dispatch_message", lambda m: processed.append(m["id"]))
+    client = bot.app.test_client()
+    payload = text_payload("57300", "videollamada")
+
+    client.post("/webhook", json=payload)
+    client.post("/webhook", json=payload)
+
+    assert len(processed) == 1
+
+
+def test_shared_dedup_store_across_workers(tmp_path):
+    db_path = str(tmp_path / "dedup.db")
+    worker_a = bot.MessageDeduplicator(db_path=db_path)
+    worker_b = bot.MessageDeduplicator(db_path=db_path)
+
+    assert worker_a.is_duplicate("wamid.shared") is False
+    assert worker_b.is_duplicate("wamid.shared") is True
+
+    worker_a.forget("wamid.shared")
+    worker_c = bot.MessageDeduplicator(db_path=db_path)
+    assert worker_c.is_duplicate("wamid.shared") is False
+
+
+def test_user_locks_serialize_same_phone(monkeypatch):
+    import threading
+
+    active = {"now": 0, "max": 0}
+    guard = threading.Lock()
+
+    def slow_text(phone, text):
+        with guard:
+            active["now"] += 1
+            active["max"] = max(active["max"], active["now"])
+        time.sleep(0.02)
+        with guard:
+            active["now"] -= 1
+
+    monkeypatch.setattr(bot, "process_text_message", slow_text)
+    message = text_payload("57300", "hola")["entry"][0]["changes"][0]["value"]["messages"][0]
+    threads = [threading.Thread(target=bot.dispatch_message, args=(message,)) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert active["max"] == 1
+    assert bot.metrics.get("user_lock_contended") >= 1
+
+
+def test_user_locks_serialize_same_phone_across_workers(tmp_path):
+    import multiprocessing
+
+    locks = bot.UserLockManager(stripes=16, path=str(tmp_path / "locks" / "users.lock"))
+    log_path = str(tmp_path / "log")
+
+    def worker(name):
+        with locks.hold("57300"):
+            with open(log_path, "a") as f:
+                f.write(f"{name}+\n")
+            time.sleep(0.2)
+            with open(log_path, "a") as f:
+                f.write(f"{name}-\n")
+
+    context = multiprocessing.get_context("fork")
+    processes = [context.Process(target=worker, args=(n,)) for n in range(3)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(5)
+
+    events = open(log_path).read().split()
+    # Cada worker sale de la sección crítica antes de que entre el siguiente
+    assert len(events) == 6
+    assert all(events[i][:-1] == events[i + 1][:-1] for i in range(0, 6, 2))
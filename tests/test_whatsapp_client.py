@@ -0,0 +1,37 @@
+import os
+import sys
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import WhatsAppClient
+
+
+def test_client_reuses_pool_and_headers():
+    requests_seen = []
+
+    def handler(request):
+        requests_seen.append(request)
+        return httpx.Response(200, json={"messages": [{"id": "wamid.1"}]})
+
+    client = WhatsAppClient("token-123", "999", transport=httpx.MockTransport(handler))
+    first = client._get_client()
+
+    assert client.send({"to": "57300"}) == {"messages": [{"id": "wamid.1"}]}
+    client.send({"to": "57301"})
+
+    assert client._get_client() is first
+    assert len(requests_seen) == 2
+    assert requests_seen[0].headers["Authorization"] == "Bearer token-123"
+    assert str(requests_seen[0].url) == "https://graph.facebook.com/v22.0/999/messages"
+    client.close()
+
+
+def test_client_returns_error_on_timeout():
+    def handler(request):
+        raise httpx.ReadTimeout("timeout", request=request)
+
+    client = WhatsAppClient("token", "999", transport=httpx.MockTransport(handler))
+
+    assert "error" in client.send({"to": "57300"})